@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+"""Benchmarks for EccoChemistry, run against a simulated Ecco
+
+Usage: python benchmark.py [options] [scenario ...]
+
+Each scenario sets up a fresh ``MemoryEcco`` file, then times an operation
+with the given simulated latency per API call, reporting its wall time and
+the number of API calls it made.  Call counts don't depend on the machine
+or the latency, so if a scenario makes more calls than the baseline recorded
+for the same number of items, the run fails.  At the default latency, the
+run also fails if a scenario takes more than twice its recorded wall time
+(see ``--time-tolerance``).  After an intentional change, use ``--update`` to
+print new ``BASELINES`` and ``SECONDS`` entries to paste in below.
+
+The test suite (``python setup.py test``) runs every scenario on 1000 items
+and checks its call counts; wall times are only checked by running this
+script directly, on the machine whose times are recorded.
+"""
+
+import sys, time, optparse
+import datetime as dt
+import ecco_chemistry as ec
+
+# items -> {scenario: API calls}
+BASELINES = {
+    1000: {
+        'iterate': 6, 'query': 6, 'resolve': 11, 'lookup': 200,
+        'indexed_lookup': 11, 'indexed_range': 2, 'tree_walk': 1001,
+        'bulk_create': 1000, 'bulk_update': 12, 'folders': 3,
+    },
+    10000: {
+        'iterate': 51, 'query': 39, 'resolve': 101, 'lookup': 200,
+        'indexed_lookup': 101, 'indexed_range': 2, 'tree_walk': 10001,
+        'bulk_create': 10000, 'bulk_update': 102, 'folders': 3,
+    },
+    100000: {
+        'iterate': 501, 'query': 376, 'resolve': 1001, 'lookup': 200,
+        'indexed_lookup': 1001, 'indexed_range': 2, 'tree_walk': 100001,
+        'bulk_create': 100000, 'bulk_update': 1002, 'folders': 3,
+    },
+}
+
+# items -> {scenario: wall time in seconds, at the default LATENCY}
+SECONDS = {
+    1000: {
+        'iterate': 0.03, 'query': 0.03, 'resolve': 0.05, 'lookup': 0.1,
+        'indexed_lookup': 0.04, 'indexed_range': 0.01, 'tree_walk': 0.21,
+        'bulk_create': 0.24, 'bulk_update': 0.05, 'folders': 0.01,
+    },
+    10000: {
+        'iterate': 0.3, 'query': 0.29, 'resolve': 0.46, 'lookup': 0.38,
+        'indexed_lookup': 0.27, 'indexed_range': 0.06, 'tree_walk': 2.18,
+        'bulk_create': 2.47, 'bulk_update': 0.63, 'folders': 0.01,
+    },
+    100000: {
+        'iterate': 5.32, 'query': 3.02, 'resolve': 4.52, 'lookup': 5.31,
+        'indexed_lookup': 4.5, 'indexed_range': 1.55, 'tree_walk': 22.75,
+        'bulk_create': 25.84, 'bulk_update': 6.61, 'folders': 0.01,
+    },
+}
+
+LATENCY = 0.0001    # default simulated seconds per API call
+SLACK = 0.1         # seconds of timing noise allowed on top of the tolerance
+
+PRIORITIES = ('Low', 'Medium', 'High')
+
+
+def define_task():
+    class Task(ec.Item):
+        due      = ec.DateFolder('Due Dates')
+        effort   = ec.NumericFolder('Effort Hours', create=True)
+        priority = ec.PopupFolder('Priority', create=True)
+        serial   = ec.TextFolder('Task Serial #', create=True)
+    return Task
+
+def task_rows(n, **kw):
+    rows = []
+    for i in range(n):
+        row = dict(
+            text='Task %d' % i, serial='S%06d' % i, effort=i % 100,
+            priority=PRIORITIES[i % 3], due=dt.date(2008, 1, 1+i%28)
+        )
+        row.update(kw)
+        rows.append(row)
+    return rows
+
+def make_tasks(n):
+    Task = define_task()
+    return Task, Task.bulk_create(task_rows(n))
+
+
+def iterate(n):
+    """Iterate over every item in a folder"""
+    Task, tasks = make_tasks(n)
+    def run():
+        for t in Task.serial:
+            pass
+    return run
+
+def query(n):
+    """Filter and sort on two folders, reading values through a cache"""
+    Task, tasks = make_tasks(n)
+    def run():
+        c = ec.ValueCache().begin()
+        try:
+            q = Task.where(
+                Task.effort >= 50, Task.due < dt.date(2008,1,15), -Task.effort
+            )
+            for t in q:
+                pass
+        finally:
+            c.end()
+    return run
+
+def resolve(n):
+    """Resolve items against a five-level deep class hierarchy"""
+    Task, tasks = make_tasks(n)
+    base, levels = Task, []
+    for level in range(1, 6):
+        folder = ec.CheckmarkFolder('Level %d' % level, create=True)
+        class Yes(base):
+            required_values = dict(level=True)
+            level = folder
+        class No(base):
+            required_values = dict(level=False)
+            level = folder
+        levels.append(folder)
+        base = Yes
+    for i, t in enumerate(tasks):
+        for folder in levels[:i % 6]:
+            folder[t.id] = True
+    def run():
+        for t in Task.serial:
+            pass
+    return run
+
+def lookup(n):
+    """Look up 100 items by key, without an index"""
+    Task, tasks = make_tasks(n)
+    keys = ['S%06d' % i for i in range(0, n, max(1, n//100))][:100]
+    def run():
+        for k in keys:
+            Task.serial.get(k)
+    return run
+
+def indexed_lookup(n):
+    """Look up every tenth item by key, using a ``KeyIndex``"""
+    Task, tasks = make_tasks(n)
+    keys = ['S%06d' % i for i in range(0, n, 10)]
+    def run():
+        index = Task.serial.index()
+        try:
+            for k in keys:
+                Task.serial.get(k)
+        finally:
+            index.drop()
+    return run
+
+def indexed_range(n):
+    """Run 20 date range queries, using a ``RangeIndex``"""
+    Task, tasks = make_tasks(n)
+    days = [dt.date(2008, 1, 1+d) for d in range(21)]
+    def run():
+        index = Task.due.range_index()
+        try:
+            for day in days[:-1]:
+                Task.due.between(day, days[-1]).count()
+        finally:
+            index.drop()
+    return run
+
+def tree_walk(n):
+    """Read a field of every descendant of each top-level item, via a snapshot
+
+    The snapshot answers the outline; each field read is still an API call.
+    """
+    Task = define_task()
+    roots = Task.bulk_create(task_rows(n//100))
+    rows = task_rows(n - len(roots))
+    for i, row in enumerate(rows):
+        row['parent'] = roots[i % len(roots)]
+    Task.bulk_create(rows)
+    def run():
+        s = ec.OutlineSnapshot().begin()
+        try:
+            for root in roots:
+                for t in root.all_children:
+                    t.serial
+        finally:
+            s.end()
+    return run
+
+def bulk_create(n):
+    """Create items in bulk"""
+    Task = define_task()
+    rows = task_rows(n)
+    def run():
+        Task.bulk_create(rows)
+    return run
+
+def bulk_update(n):
+    """Update one field of every item, via ``sync()``"""
+    Task, tasks = make_tasks(n)
+    records = [
+        dict(serial='S%06d' % i, effort=i % 100 + 1) for i in range(n)
+    ]
+    def run():
+        Task.serial.sync(records, fields=['effort'])
+    return run
+
+def folders(n):
+    """Walk a folder outline of 200 extra folders, using a schema"""
+    for i in range(200):
+        ec.TextFolder('Extra %d' % i, True)
+    def run():
+        schema = ec.FolderSchema().begin()
+        try:
+            def walk(f):
+                for child in f.children:
+                    child.depth
+                    walk(child)
+            for f in ec.Folder:
+                walk(f)
+        finally:
+            schema.end()
+    return run
+
+SCENARIOS = [
+    iterate, query, resolve, lookup, indexed_lookup, indexed_range, tree_walk,
+    bulk_create, bulk_update, folders,
+]
+
+
+def measure(scenario, items, latency):
+    """Run `scenario` on a fresh file; return ``(seconds, calls)``"""
+    sim = ec.MemoryEcco()
+    saved, ec.Ecco = ec.Ecco, sim
+    try:
+        sim.NewFile()
+        run = scenario(items)
+        sim.reset_stats()
+        sim.latency = latency
+        start = time.time()
+        run()
+        return time.time() - start, sim.total_calls()
+    finally:
+        ec.Ecco = saved
+
+def regressions(results, items, tolerance=0.0, time_tolerance=None):
+    """List the names of `results` that exceed the baselines for `items`
+
+    `results` is a list of ``(name, seconds, calls)``.  A scenario regresses if
+    it makes more calls than its baseline allows (plus `tolerance`, as a
+    fraction), or, if `time_tolerance` isn't None, takes longer than its
+    recorded time plus that fraction (and ``SLACK`` seconds).
+    """
+    calls_base = BASELINES.get(items, {})
+    time_base = SECONDS.get(items, {})
+    failed = []
+    for name, seconds, calls in results:
+        if name in calls_base and calls > calls_base[name] * (1 + tolerance):
+            failed.append(name)
+        elif time_tolerance is not None and name in time_base and (
+            seconds > time_base[name] * (1 + time_tolerance) + SLACK
+        ):
+            failed.append(name)
+    return failed
+
+def test_call_counts():
+    """Check the call counts of every scenario on 1000 items (for the tests)
+
+    Wall times depend on the machine, so they're only checked by running
+    this script directly.
+    """
+    results = [
+        (s.__name__,) + measure(s, 1000, 0) for s in SCENARIOS
+    ]
+    failed = regressions(results, 1000)
+    assert not failed, "Call count regressions: %s" % ', '.join(failed)
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog [options] [scenario ...]")
+    parser.add_option("-n", "--items", type="int", default=10000,
+        help="number of items per scenario (default 10000)")
+    parser.add_option("-l", "--latency", type="float", default=LATENCY,
+        help="simulated seconds per API call (default %s)" % LATENCY)
+    parser.add_option("-t", "--tolerance", type="float", default=0.0,
+        help="fraction by which calls may exceed the baseline (default 0)")
+    parser.add_option("-w", "--time-tolerance", type="float", default=1.0,
+        help="fraction by which wall time may exceed the baseline"
+             " (default 1.0, i.e. twice as slow); only checked at the"
+             " default latency")
+    parser.add_option("-u", "--update", action="store_true",
+        help="print BASELINES and SECONDS entries for this run,"
+             " instead of failing")
+    options, args = parser.parse_args(argv)
+
+    by_name = dict([(s.__name__, s) for s in SCENARIOS])
+    for name in args:
+        if name not in by_name:
+            parser.error("Unknown scenario: %s" % name)
+    scenarios = [by_name[name] for name in args] or SCENARIOS
+    baselines = BASELINES.get(options.items, {})
+    times = SECONDS.get(options.items, {})
+    time_tolerance = None
+    if options.latency == LATENCY:
+        time_tolerance = options.time_tolerance
+
+    results = []
+    print "%-16s %10s %8s %8s %8s" % (
+        "scenario", "seconds", "baseline", "calls", "baseline"
+    )
+    for scenario in scenarios:
+        name = scenario.__name__
+        seconds, calls = measure(scenario, options.items, options.latency)
+        results.append((name, seconds, calls))
+        status = ''
+        if regressions(
+            results[-1:], options.items, options.tolerance, time_tolerance
+        ):
+            status = '  REGRESSION'
+        print "%-16s %10.3f %8s %8d %8s%s" % (
+            name, seconds, times.get(name, '-'), calls,
+            baselines.get(name, '-'), status
+        )
+
+    if options.update:
+        print
+        print "    %d: %r," % (
+            options.items, dict([(n, c) for n, t, c in results])
+        )
+        print "    %d: %r," % (
+            options.items, dict([(n, round(t, 2)) for n, t, c in results])
+        )
+        return 0
+    failed = regressions(
+        results, options.items, options.tolerance, time_tolerance
+    )
+    if failed:
+        print
+        print "Regressions:", ', '.join(failed)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,43 +1,23 @@
 from ecco_dde import *
 from peak.util.decorators import decorate, classy
-import datetime, operator
+import bisect, datetime, operator, sys, time
 from decimal import Decimal
 
 Ecco = EccoDDE()
+cache = None    # active ValueCache or Session, if any (see ValueCache.begin())
+schema = None   # active FolderSchema, if any (see FolderSchema.begin())
+snapshot = None # active OutlineSnapshot, if any (see OutlineSnapshot.begin())
+pool = None     # active EccoPool, if any (see EccoPool.begin())
+text_index = None   # active TextIndex, if any (see TextIndex.begin())
 
 __all__ = [
     'Ecco', 'Item', 'CheckmarkFolder', 'TextFolder', 'PopupFolder',
-    'DateFolder', 'NumericFolder', 'Folder', 'Parent', 'Children'
+    'DateFolder', 'NumericFolder', 'Folder', 'Parent', 'Children',
+    'MemoryEcco', 'FolderSchema', 'ValueCache', 'Session', 'Query',
+    'SetQuery', 'KeyIndex', 'OutlineSnapshot', 'Tracer', 'EccoPool',
+    'Replica', 'TextIndex', 'RangeIndex',
 ]
 
-def intersect(first, second, *rest):
-    ok = set(second)
-    for s in rest:
-        ok &= set(s)
-    for item in first:
-        if item in ok:
-            yield item
-
-def union(*sequences):
-    seen = {}
-    for seq in sequences:
-        for item in seq:
-            if item not in seen:
-                seen[item] = 1
-                yield item
-
-
-
-
-
-
-
-
-
-
-
-
-
 
 class _ItemChildren(object):
     """Container for an item's children"""
@@ -47,37 +27,84 @@ class _ItemChildren(object):
         self.parentid = parentid
         self.depth = depth
 
+    pagesize = 200  # number of children to resolve per batch of API calls
+    readahead = 0   # number of batches to fetch ahead in a background thread
+
     def __iter__(self):
-        for depth, id in Ecco.GetItemSubs(self.parentid, self.depth):
-            cls = _find_item_subclass(self.itemtype, id)
-            if cls is not None: yield cls(id, __class__=cls)        
+        return _hydrate(
+            self.itemtype, self._ids(), self.pagesize, self.readahead,
+            type(self).__name__ + '.__iter__'
+        )
+
+    def _ids(self):
+        if snapshot is not None and self.parentid in snapshot.load().subs:
+            subs = snapshot.walk(self.parentid, self.depth)
+        else:
+            _before_query()
+            subs = Ecco.GetItemSubs(self.parentid, self.depth)
+        return [id for depth, id in subs]
 
     def __nonzero__(self):
-        for sub in self: return True
-        return False
+        return self.exists()
 
     def __len__(self):
-        return len(list(iter(self)))    # iter prevents recursion
+        return self.count()
+
+    def __getitem__(self, index):
+        """The child at `index`, or a list of those in a slice"""
+        if isinstance(index, slice):
+            return _slice_items(
+                self.itemtype, self._ids(), index, self.pagesize
+            )
+        items = _slice_items(
+            self.itemtype, self._ids(), slice(index, index+1 or None),
+            self.pagesize
+        )
+        if not items:
+            raise IndexError(index)
+        return items[0]
+
+    def first(self, default=None):
+        """The first child, or `default` if there are none"""
+        for item in _first_items(self.itemtype, self._ids(), 1, self.pagesize):
+            return item
+        return default
+
+    def exists(self):
+        """True if there is at least one child"""
+        return _exists(self.itemtype, self._ids(), self.pagesize)
+
+    def count(self):
+        """The number of children, counted without creating them"""
+        return _count_items(self.itemtype, self._ids(), self.pagesize)
 
     def __contains__(self, item):
         if isinstance(item, self.itemtype):
-            parents = Ecco.GetItemParents(int(item))
-            return self.parentid in parents[:-self.depth or len(parents)]
+            if snapshot is not None and int(item) in snapshot:
+                parents = snapshot.ancestors(item)
+            else:
+                _before_query()
+                parents = Ecco.GetItemParents(int(item))
+            return self.parentid in parents[-self.depth:]
         return False
 
     def extend(self, items):
         items = map(int, items)[::-1]
-        subs = Ecco.GetItemSubs(self.parentid, 1)
+        if snapshot is not None and self.parentid in snapshot.load().subs:
+            subs = snapshot.walk(self.parentid, 1)
+        else:
+            _before_query()
+            subs = Ecco.GetItemSubs(self.parentid, 1)
         if subs:
-            Ecco.InsertItem(subs[-1][1], items, InsertLevel.Same)
+            _insert(subs[-1][1], items, InsertLevel.Same)
         else:
-            Ecco.InsertItem(self.parentid, items)
+            _insert(self.parentid, items)
 
     def append(self, item):
         self.extend([item])
 
     def prepend(self, item):
-        Ecco.InsertItem(self.parentid, int(item))
+        _insert(self.parentid, [int(item)])
 
 
 class Children(object):
@@ -94,14 +121,38 @@ class Children(object):
         return _ItemChildren(self.itemtype or typ, int(ob), self.depth)
         
     def __set__(self, ob, value):
-        value = list(value)[::-1]
-        # unlink children
-        Ecco.InsertItem(0, [
-            int(i) for i in _ItemChildren(self.itemtype, int(ob), 1) if i!=ob
-        ])
-        if value:
-            it = self.itemtype or type(ob)
-            Ecco.InsertItem(int(ob), [int(it(i)) for i in value if i!=ob])
+        it = self.itemtype or type(ob)
+        parentid, wanted, seen = int(ob), [], {}
+        for i in value:
+            if not isinstance(i, it):
+                i = it(i)
+            if i!=ob and int(i) not in seen:
+                wanted.append(int(i))
+                seen[int(i)] = True
+
+        current = _ItemChildren(it, parentid)._ids()
+        if _accepts_all(it):
+            managed = current
+        else:
+            managed = [int(i) for i in _hydrate(it, current)]
+        # unlink children that aren't wanted any more
+        removed = [i for i in managed if i not in seen]
+        _insert(0, removed)
+        removed = dict.fromkeys(removed)
+        current = [i for i in current if i not in removed]
+
+        # wanted items come first, followed by any children of other types
+        wanted.extend([i for i in current if i not in seen])
+        order = dict([(i, n) for n, i in enumerate(wanted)])
+        stays = _longest_run([order[i] for i in current if i in order])
+        anchor, moving = 0, []
+        for n, i in enumerate(wanted):
+            if n in stays:
+                _move_after(parentid, anchor, moving)
+                anchor, moving = i, []
+            else:
+                moving.append(i)
+        _move_after(parentid, anchor, moving)
 
     def __delete__(self, ob):
         self.__set__(ob, ())
@@ -121,6 +172,51 @@ class Children(object):
 
 
 
+def _longest_run(seq):
+    """Set of the values in the longest increasing subsequence of `seq`"""
+    tails, back = [], {}
+    for v in seq:
+        pos = bisect.bisect_left(tails, v)
+        if pos:
+            back[v] = tails[pos-1]
+        else:
+            back[v] = None
+        tails[pos:pos+1] = [v]
+    result = {}
+    if tails:
+        v = tails[-1]
+        while v is not None:
+            result[v] = True
+            v = back[v]
+    return result
+
+def _move_after(parentid, anchor, items):
+    """Move `items`, in order, after child `anchor` (0 for first) of parent"""
+    if anchor:
+        _insert(anchor, items[::-1], InsertLevel.Same)
+    else:
+        _insert(parentid, items[::-1])
+
+def reparent(mapping):
+    """Move items to new parents, given a mapping or ``(item, parent)`` pairs
+
+    A parent of None (or 0) makes the item a top-level item.  Items moved to
+    the same parent are placed at the start of its children, in the order
+    given, using one ``InsertItem()`` call per distinct parent.
+    """
+    if hasattr(mapping, 'items'):
+        mapping = mapping.items()
+    moves, order = {}, []
+    for item, parent in mapping:
+        parent = int(parent or 0)
+        if parent not in moves:
+            moves[parent] = []
+            order.append(parent)
+        moves[parent].append(int(item))
+    for parent in order:
+        _insert(parent, moves[parent][::-1])
+
+
 class Parent(object):
     """Property for parent item of a given type"""
 
@@ -131,8 +227,12 @@ class Parent(object):
     def __get__(self, ob, typ):
         if ob is None:
             return self
-        parents = Ecco.GetItemParents(int(ob))
-        if parents:
+        if snapshot is not None and int(ob) in snapshot:
+            parents = [snapshot.parent(ob)]
+        else:
+            _before_query()
+            parents = Ecco.GetItemParents(int(ob))
+        if parents and parents[-1]:
             cls = _find_item_subclass(self.itemtype or typ, parents[-1])
             if cls:
                 return cls(parents[-1], __class__ = cls)
@@ -144,7 +244,7 @@ class Parent(object):
         else:
             assert self.itemtype is None or isinstance(value, self.itemtype)
             parent = int(value)
-        Ecco.InsertItem(parent, int(ob))
+        _insert(parent, [int(ob)])
 
     def __delete__(self, ob):
         self.__set__(ob, None)
@@ -188,9 +288,33 @@ class ItemClass(type(classy)):
     def __neg__(self):
         return self._query("id")
 
+    def where(self, *conditions):
+        """Query for items matching all of `conditions` (see ``Query``)"""
+        return Query(self, *conditions)
+
+    def export(self, stream, fields, format='jsonl'):
+        """Write `fields` of all items to `stream` (see ``_ItemQuery`` docs)"""
+        return self._query().export(stream, fields, format)
+
+    def columns(self, *names, **options):
+        """Column-oriented values of all items (see ``_ItemQuery`` docs)"""
+        return self._query().columns(*names, **options)
+
+    def values(self, *names, **options):
+        """Tuples of field values for all items (see ``_ItemQuery`` docs)"""
+        return self._query().values(*names, **options)
+
+    def rows(self, *names, **options):
+        """Read-only records for all items (see ``_ItemQuery`` docs)"""
+        return self._query().rows(*names, **options)
+
+
+def _always_valid(values):
+    return True
 
 _folder_bits = {}
 _folder_bit = 1
+_dispatchers = {}   # (cls, root) -> _Dispatcher; cleared when classes change
 
 def _folder_mask(fid):
     try:
@@ -214,15 +338,25 @@ class Item(classy, int):
             d.update(kw)
             if d: vals, attrs, extra = cls._attrvalues(d)
             cls = _find_item_subclass(cls, None, vals, True)
-            id_or_text = Ecco.CreateItem(id_or_text,vals)
+            text, id_or_text = id_or_text, Ecco.CreateItem(id_or_text,vals)
+            _outline_changed()
+            if text_index is not None:
+                text_index.set_text(id_or_text, text)
+            if vals:
+                fids, values = zip(*vals)
+                _notify(id_or_text, fids, values, cls)
+            if cache is not None and vals:
+                cache.remember(id_or_text, None, dict(vals))
         else:
             if kw: vals, attrs, extra = cls._attrvalues(kw)
             if '__class__' in kw:
                 cls = kw.pop('__class__')   # fast path for collections
             else:
                 cls = _find_item_subclass(cls, id_or_text, vals, True)
-            if vals: Ecco.SetFolderValues(id_or_text, *zip(*vals))
+            if vals: _set_values(id_or_text, *zip(*vals))
         self = super(Item, cls).__new__(cls, id_or_text)
+        if cache is not None:
+            self = cache.identity(self)
         if attrs:
             for k, v in attrs: setattr(self, k, v)
         return self
@@ -235,9 +369,9 @@ class Item(classy, int):
         return True
 
     def text(self):
-        return Ecco.GetItemText(int(self))
+        return _get_text(int(self))
     def _set_text(self, value):
-        Ecco.SetItemText(int(self), value)
+        _set_text(int(self), value)
 
     text = property(text, _set_text)
 
@@ -285,15 +419,14 @@ class Item(classy, int):
             _folder_mask(folder.id) # ensure the value will be retrieved
             decoders.append((folder.id, folder.decode))
 
-        def _validate_fields(values):
-            return True
-
+        _validate_fields = _always_valid
         if decoders:
             def _validate_fields(values, decoders=decoders):
                 vget = values.get
                 return checker(*[d(vget(f)) for f,d in decoders])
 
         cls._validate_fields = staticmethod(_validate_fields)
+        _dispatchers.clear()
 
     decorate(classmethod)
     def _attrvalues(cls, d):
@@ -313,9 +446,80 @@ class Item(classy, int):
     def update(self, **kw):
         """Set multiple attributes at once"""
         vals, attrs, extra = self._attrvalues(kw)
-        if vals: Ecco.SetFolderValues(int(self), *zip(*vals))
+        if vals: _set_values(int(self), *zip(*vals))
         for k, v in attrs: setattr(self, k, v)
 
+    decorate(classmethod)
+    def bulk_create(cls, rows, chunk_size=200):
+        """Create an item for each of `rows`, returning the items in order
+
+        Each row is a dictionary of attribute values, with the item's text
+        (a string, passed to Ecco as is, like the text given to an item class)
+        under ``'text'``.  All rows are checked and encoded (and their item
+        classes determined) before any item is created, so that a bad row
+        doesn't leave a partial import behind.  Items are then created
+        `chunk_size` rows at a time: one ``CreateItem()`` call per row (with
+        its folder values), then one ``InsertItem()`` call per distinct
+        ``Parent`` attribute value in the chunk, placing the new children in
+        input order.  Any other non-folder attributes are set one at a time.
+        """
+        prepared = []
+        for row in rows:
+            if not isinstance(row, dict):
+                raise TypeError("Rows must be dictionaries:", row)
+            d = cls.default_values.copy()
+            d.update(row)
+            text = d.pop('text', None)
+            if text is None:
+                raise ValueError("Row has no 'text':", row)
+            elif not isinstance(text, basestring):
+                raise TypeError("Item text must be a string:", text)
+            vals, attrs, extra = cls._attrvalues(d)
+            sub = _find_item_subclass(cls, None, vals, True)
+            parent, others = None, []
+            for k, v in attrs:
+                descr = getattr(cls, k)
+                if not isinstance(descr, Parent):
+                    others.append((k, v))
+                elif v is not None:
+                    if descr.itemtype and not isinstance(v, descr.itemtype):
+                        raise TypeError("Parent must be a", descr.itemtype, v)
+                    parent = int(v)
+            prepared.append((sub, text, vals, parent, others))
+
+        items, last = [], {}    # last: parent -> last child placed so far
+        for start in range(0, len(prepared), chunk_size):
+            chunk, moves, order = [], {}, []
+            for sub, text, vals, parent, others in (
+                prepared[start:start+chunk_size]
+            ):
+                itemid = Ecco.CreateItem(text, vals)
+                if text_index is not None:
+                    text_index.set_text(itemid, text)
+                if vals:
+                    fids, values = zip(*vals)
+                    _notify(itemid, fids, values, sub)
+                    if cache is not None:
+                        cache.remember(itemid, None, dict(vals))
+                if parent is not None:
+                    if parent not in moves:
+                        moves[parent] = []
+                        order.append(parent)
+                    moves[parent].append(itemid)
+                chunk.append((sub(itemid, __class__=sub), others))
+            _outline_changed()
+            for parent in order:
+                children = moves[parent]
+                if parent in last:
+                    _insert(last[parent], children[::-1], InsertLevel.Same)
+                else:
+                    _insert(parent, children[::-1])
+                last[parent] = children[-1]
+            for item, others in chunk:
+                for k, v in others: setattr(item, k, v)
+                items.append(item)
+        return items
+
 
 
 
@@ -329,7 +533,7 @@ class Item(classy, int):
     decorate(classmethod)
     def upgrade(cls, itemid, **kw):
         """Upgrade `itemid` to this class by initializing required values"""
-        fids = dict.fromkeys(Ecco.GetItemFolders(itemid))
+        fids = dict.fromkeys(_item_folders(itemid))
         d = cls.default_values.copy()
         for k, v in d.items():
             if v is not None:
@@ -339,6 +543,66 @@ class Item(classy, int):
         d.update(kw)
         return cls(itemid, **d)
 
+    decorate(classmethod)
+    def resolve_many(cls, ids, pagesize=200):
+        """List an item of the right subclass for each of `ids`, or None
+
+        Like calling the class on each id, except that ids that don't resolve
+        to this class (or one of its subclasses) give None instead of an
+        error, and that the ids' folders and values are fetched in bulk (two
+        API calls per `pagesize` ids not already known to the active cache).
+        """
+        ids = map(int, ids)
+        result = []
+        for itemid, (fids, values) in zip(ids, _item_states(ids, pagesize)):
+            sub = _resolve_subclass(cls, fids, values, itemid)
+            if sub is not None:
+                sub = sub(itemid, __class__=sub)
+            result.append(sub)
+        return result
+
+    decorate(classmethod)
+    def upgrade_many(cls, ids, pagesize=200, **kw):
+        """Upgrade each of `ids` to this class, like ``upgrade()``; list items
+
+        The ids' folders are read in bulk, and all the ids are checked before
+        anything is written, so that if any of them can't be upgraded (a
+        ``TypeError``), none of them are.  The values are then written with
+        one ``SetFolderValues()`` call per distinct set of folders written.
+        """
+        ids = map(int, ids)
+        d = cls.default_values.copy()
+        d.update(kw)
+        vals, attrs, extra = cls._attrvalues(d)
+        optional = {}   # folders whose defaults are skipped if already set
+        for k, v in cls.default_values.items():
+            if v is not None and k not in kw:
+                descr = getattr(cls, k)
+                if isinstance(descr, Container):
+                    optional[descr.folder.id] = True
+        subs, writes = [], {}   # (folder ids) -> ([item ids], [rows])
+        for itemid, (fids, values) in zip(ids, _item_states(ids, pagesize)):
+            present = dict.fromkeys(fids)
+            data = [
+                (fid, v) for fid, v in vals
+                    if fid not in optional or fid not in present
+            ]
+            subs.append(
+                _resolve_subclass(cls, fids, values, itemid, data, True)
+            )
+            if data:
+                data.sort()
+                wfids = tuple([fid for fid, v in data])
+                wids, rows = writes.setdefault(wfids, ([], []))
+                wids.append(itemid)
+                rows.append([v for fid, v in data])
+        for wfids, (wids, rows) in writes.items():
+            _set_many(wids, list(wfids), rows)
+        items = [sub(itemid, __class__=sub) for sub, itemid in zip(subs, ids)]
+        for item in items:
+            for k, v in attrs: setattr(item, k, v)
+        return items
+
     parent = Parent()
     children = Children()
     all_children = Children(depth=0)
@@ -367,8 +631,416 @@ class Item(classy, int):
 
 
 
-class Container(object):
+class _ItemQuery(object):
+    """Base for lazily-evaluated sets of items, computed from item ids
+
+    Subclasses must define ``itemtype`` and an ``_ids()`` method returning a
+    list of item ids; iteration resolves the ids' classes in batches.  The
+    ``&``, ``|`` and ``-`` operators return a ``SetQuery``, which does its set
+    algebra on the operands' ids, only resolving the ids that survive.
+    """
+
+    pagesize = 200  # number of items to resolve per batch of API calls
+    readahead = 0   # number of batches to fetch ahead in a background thread
+
+    def __iter__(self):
+        return _hydrate(
+            self.itemtype, self._ids(), self.pagesize, self.readahead,
+            type(self).__name__ + '.__iter__'
+        )
+
+    def __and__(self, other):  return SetQuery('&', self, other)
+    def __rand__(self, other): return SetQuery('&', other, self)
+    def __or__(self, other):  return SetQuery('|', self, other)
+    def __ror__(self, other): return SetQuery('|', other, self)
+    def __sub__(self, other):  return SetQuery('-', self, other)
+    def __rsub__(self, other): return SetQuery('-', other, self)
+
+    def __getitem__(self, index):
+        """List the items in slice `index` (e.g. ``query[:50]``)"""
+        if isinstance(index, slice):
+            return _slice_items(
+                self.itemtype, self._ids(), index, self.pagesize
+            )
+        raise TypeError("Queries can only be sliced", index)
+
+    def first(self, default=None):
+        """The first item, or `default` if there are none"""
+        for item in _first_items(self.itemtype, self._ids(), 1, self.pagesize):
+            return item
+        return default
+
+    def exists(self):
+        """True if there is at least one item"""
+        return _exists(self.itemtype, self._ids(), self.pagesize)
+
+    def count(self):
+        """The number of items, counted without creating them"""
+        return _count_items(self.itemtype, self._ids(), self.pagesize)
+
+    def _scan(self, fids=(), text=False):
+        """Yield ``(item, values, text)`` for the items, a page at a time
+
+        `values` maps folder ids to raw values, for those of `fids` (and of the
+        folders used to resolve item classes) that the item is in.  `text` is
+        the item's text if requested, or None.  Each page of ``pagesize`` items
+        takes a fixed number of API calls, and is yielded before the next page
+        is read.
+        """
+        ids, itemtype = self._ids(), self.itemtype
+        pagesize = self.pagesize or len(ids)
+        def fetch(page):
+            texts = text and Ecco.GetItemText(page) or [None]*len(page)
+            result = []
+            for itemid, (ifids, values), t in zip(
+                page, _fetch_folders(page, fids), texts
+            ):
+                cls = _resolve_subclass(itemtype, ifids, values, itemid)
+                if cls is not None:
+                    result.append((cls, itemid, values, t))
+            return result
+        for page in _map_pages(fetch, [
+            ids[start:start+pagesize]
+            for start in range(0, len(ids), pagesize or 1)
+        ]):
+            for cls, itemid, values, t in page:
+                yield cls(itemid, __class__=cls), values, t
+
+    def _rows(self, names):
+        """Yield ``(item, [value])`` with the decoded values of `names`"""
+        fields = _fields(self.itemtype, names)
+        fids = [f.id for n, f in fields if f is not None]
+        for item, values, text in self._scan(fids, 'text' in names):
+            row = []
+            for name, folder in fields:
+                if folder is not None:
+                    row.append(folder.decode(values.get(folder.id, '')))
+                elif name=='text':
+                    row.append(text)
+                else:
+                    row.append(int(item))
+            yield item, row
+
+    def export(self, stream, fields, format='jsonl'):
+        """Write `fields` of the items to `stream`, returning the row count
+
+        `fields` is a list of folder attribute names, which may also include
+        ``'text'`` and ``'id'``.  If `format` is ``'jsonl'``, each item is
+        written as a line holding a JSON object; if it's ``'csv'``, a header
+        row of field names is written first, followed by a row per item.
+        Dates are written in ISO format, decimals as strings, and empty values
+        as ``null`` (JSON) or an empty string (CSV).  Text is written to CSV
+        as the Windows (cp1252) bytes Ecco uses, and to JSON as Unicode.  Rows
+        are written a page at a time, so memory use doesn't depend on the
+        number of items.
+        """
+        if format=='csv':
+            import csv
+            writer = csv.writer(stream)
+            writer.writerow(fields)
+            def write(row):
+                writer.writerow(map(_export_value, row))
+        elif format=='jsonl':
+            try:
+                import json
+            except ImportError:
+                import simplejson as json
+            names = [json.dumps(name) + ': ' for name in fields]
+            def write(row):
+                stream.write('{%s}\n' % ', '.join([
+                    n + json.dumps(_export_value(v), encoding='cp1252')
+                    for n, v in zip(names, row)
+                ]))
+        else:
+            raise ValueError("Unknown export format:", format)
+        count = 0
+        for item, row in self._rows(fields):
+            write(row)
+            count += 1
+        return count
+
+    def columns(self, *names, **options):
+        """Return ``[ids, column, ...]`` with a column of values per name
+
+        `names` are folder attribute names, ``'text'`` or ``'id'``, as for
+        ``export()``.  Each column is a list of the decoded values of one field
+        for all of the items, in the same order as the list of item ids that
+        comes first.  Values are fetched in bulk, and each column is decoded in
+        one pass by its folder's ``decode_many()`` method.
+
+        If the ``arrays`` option is true, NumPy arrays are returned instead of
+        lists: dates and times become ``datetime64`` values (``NaT`` if empty),
+        numbers become floats (``nan`` if empty) unless the ``exact`` option is
+        also true, checkmarks become booleans, and text becomes objects.
+        """
+        arrays = options.pop('arrays', False)
+        exact = options.pop('exact', False)
+        if options:
+            raise TypeError("Unknown options:", options.keys())
+        if arrays:
+            import numpy
+        fields = _fields(self.itemtype, names)
+        fids = [f.id for n, f in fields if f is not None]
+        ids, raw = _fetch_columns(
+            self.itemtype, self._ids(), fids, self.pagesize
+        )
+        texts = []
+        if 'text' in names and ids:
+            texts = Ecco.GetItemText(ids)
+        result = [ids]
+        for name, folder in fields:
+            if folder is not None:
+                if arrays:
+                    column = folder.decode_array(raw[folder.id], numpy, exact)
+                else:
+                    column = folder.decode_many(raw[folder.id])
+            elif name=='text':
+                column = list(texts)
+                if arrays:
+                    column = numpy.array(column, dtype=object)
+            else:
+                column = list(ids)
+                if arrays:
+                    column = numpy.array(column, dtype=int)
+            result.append(column)
+        if arrays:
+            result[0] = numpy.array(ids, dtype=int)
+        return result
+
+    def values(self, *names, **options):
+        """Yield a tuple of the decoded values of `names` for each item
+
+        `names` are folder attribute names, ``'text'``, ``'id'`` or
+        ``'parent'`` (the id of the item's parent, or None for a top-level
+        item).  No items are created: each page of ``pagesize`` items costs
+        one call for the folder values, plus one for the text and one for the
+        parents if requested, and each field is decoded a page at a time.
+
+        Ids are not resolved to item classes, so every item found by the query
+        is included, unless the ``resolve`` option is true, in which case the
+        items that don't resolve to the query's item type are skipped (at the
+        cost of an extra call per page).
+        """
+        resolve = options.pop('resolve', False)
+        if options:
+            raise TypeError("Unknown options:", options.keys())
+        if not names:
+            raise TypeError("At least one field name is required")
+        itemtype = self.itemtype
+        fields = _fields(itemtype, names, ('text', 'id', 'parent'))
+        fids = [f.id for n, f in fields if f is not None]
+        def fetch(page):
+            if resolve:
+                found = []
+                for itemid, (ifids, values) in zip(
+                    page, _fetch_folders(page, fids)
+                ):
+                    if _resolve_subclass(itemtype, ifids, values, itemid):
+                        found.append((itemid, values))
+                if not found:
+                    return []
+                page, raw = map(list, zip(*found))
+            elif fids:
+                raw = [
+                    dict(zip(fids, row))
+                    for row in Ecco.GetFolderValues(page, fids)
+                ]
+            else:
+                raw = [{}] * len(page)
+            columns = []
+            for name, folder in fields:
+                if folder is not None:
+                    fid = folder.id
+                    columns.append(
+                        folder.decode_many([r.get(fid, '') for r in raw])
+                    )
+                elif name=='text':
+                    columns.append(Ecco.GetItemText(page))
+                elif name=='parent':
+                    columns.append(_parent_ids(page))
+                else:
+                    columns.append(page)
+            return zip(*columns)
+        _before_query()
+        ids = self._ids()
+        pagesize = self.pagesize or len(ids)
+        for page in _map_pages(fetch, [
+            ids[start:start+pagesize]
+            for start in range(0, len(ids), pagesize or 1)
+        ]):
+            for row in page:
+                yield row
+
+    def rows(self, *names, **options):
+        """Yield a read-only ``Row`` of the values of `names` for each item
+
+        Rows are tuples whose values can also be read as attributes named after
+        the fields; otherwise, this is the same as ``values()``.
+        """
+        row = _row_class(names)
+        for values in self.values(*names, **options):
+            yield row(values)
+
+
+def _fetch_columns(itemtype, ids, fids, pagesize=None):
+    """Return ``(ids, {fid: [raw value]})`` for the `ids` of type `itemtype`
+
+    If every item is acceptable to `itemtype`, all the values are read with
+    one ``GetFolderValues()`` call; otherwise, ids are resolved a page at a
+    time, reading the values along with the folders needed for resolution, and
+    ids that don't resolve are dropped.
+    """
+    _before_query()
+    if _accepts_all(itemtype):
+        rows = ids and fids and Ecco.GetFolderValues(ids, fids) or []
+        columns = map(list, zip(*rows)) or [[] for fid in fids]
+        return ids, dict(zip(fids, columns))
+    pagesize = pagesize or len(ids)
+    def fetch(page):
+        result = []
+        for itemid, (ifids, values) in zip(page, _fetch_folders(page, fids)):
+            if _resolve_subclass(itemtype, ifids, values, itemid) is not None:
+                result.append((itemid, values))
+        return result
+    found, columns = [], dict([(fid, []) for fid in fids])
+    for page in _map_pages(fetch, [
+        ids[start:start+pagesize]
+        for start in range(0, len(ids), pagesize or 1)
+    ]):
+        for itemid, values in page:
+            found.append(itemid)
+            for fid in fids:
+                columns[fid].append(values.get(fid, ''))
+    return found, columns
+
+
+def _fields(itemtype, names, special=('text', 'id')):
+    """List ``(name, folder)`` for `names` (folder is None for `special`)"""
+    fields = []
+    for name in names:
+        if name in special:
+            fields.append((name, None))
+            continue
+        descr = getattr(itemtype, name, None)
+        if not isinstance(descr, Container):
+            raise TypeError("No such folder attribute:", name)
+        fields.append((name, descr.folder))
+    return fields
+
+def _parent_ids(ids):
+    """List the parent ids of `ids` (None for top-level items)"""
+    if snapshot is not None:
+        if not [itemid for itemid in ids if itemid not in snapshot]:
+            return [snapshot.parent(itemid) or None for itemid in ids]
+    return [
+        parents and parents[-1] or None
+        for parents in Ecco.GetItemParents(ids)
+    ]
+
+
+class Row(tuple):
+    """Read-only record of field values, as yielded by ``rows()``"""
+
+    __slots__ = ()
+    fields = ()
+
+    def __repr__(self):
+        return "Row(%s)" % ', '.join([
+            '%s=%r' % pair for pair in zip(self.fields, self)
+        ])
+
+_row_classes = {}
+
+def _row_class(names):
+    """`Row` subclass with attributes for `names` (cached by names)"""
+    names = tuple(names)
+    if names not in _row_classes:
+        attrs = dict(__slots__=(), fields=names)
+        for n, name in enumerate(names):
+            attrs.setdefault(name, property(operator.itemgetter(n)))
+        _row_classes[names] = type('Row', (Row,), attrs)
+    return _row_classes[names]
+
+def _export_value(value):
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    elif isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+def _operand_ids(ob, itemtype):
+    """Ids of the items in `ob` (a query or iterable) of type `itemtype`"""
+    if not isinstance(ob, _ItemQuery):
+        return [int(item) for item in ob]   # already-resolved items
+    ids = ob._ids()
+    if ob.itemtype is not itemtype and not _accepts_all(ob.itemtype):
+        # only items of the operand's own type count, so resolve their classes
+        # a page at a time, without creating the items
+        size = ob.pagesize or len(ids) or 1
+        pages = [ids[start:start+size] for start in range(0, len(ids), size)]
+        ids = []
+        for page in _map_pages(
+            lambda page: _resolve_page(ob.itemtype, page), pages
+        ):
+            ids.extend([itemid for sub, itemid in page])
+    return ids
+
+
+class SetQuery(_ItemQuery):
+    """Intersection ('&'), union ('|') or difference ('-') of item sets
+
+    The result is ordered by the first operand, followed (for unions) by the
+    items of the remaining operands that weren't already included.  Items
+    are resolved using the item type of the first operand that has one.
+    """
+
+    def __init__(self, op, *operands):
+        self.op = op
+        self.operands = operands
+        for ob in operands:
+            if isinstance(ob, _ItemQuery):
+                self.itemtype = ob.itemtype
+                self.pagesize = ob.pagesize
+                self.readahead = ob.readahead
+                break
+        else:
+            raise TypeError("At least one operand must be a query", operands)
+
+    def __repr__(self):
+        return "(%s)" % (' %s ' % self.op).join(map(repr, self.operands))
+
+    def _ids(self):
+        if pool is None:
+            ids = [_operand_ids(ob, self.itemtype) for ob in self.operands]
+        else:
+            _before_query()     # flush any writes before fanning out
+            ids = pool.map(
+                lambda ob: _operand_ids(ob, self.itemtype), self.operands
+            )
+        result = ids.pop(0)
+        if self.op=='&':
+            for other in ids:
+                other = dict.fromkeys(other)
+                result = [i for i in result if i in other]
+        elif self.op=='|':
+            seen = dict.fromkeys(result)
+            for other in ids:
+                for i in other:
+                    if i not in seen:
+                        seen[i] = True
+                        result.append(i)
+        else:
+            exclude = {}
+            for other in ids:
+                exclude.update(dict.fromkeys(other))
+            result = [i for i in result if i not in exclude]
+        return result
+
+
+class Container(_ItemQuery):
     """Find items in a given folder/itemtype"""
+
     def __init__(self, itemtype, folder, criteria=()):
         self.folder = folder
         self.itemtype = itemtype
@@ -376,12 +1048,21 @@ class Container(object):
         self.criteria = criteria
 
     def _query(self, *criteria):
-        return Container(self.itemtype, self.folder, self.criteria+criteria)
-
-    def __iter__(self):
-        for id in Ecco.GetFolderItems(self.folder.id, *self.criteria):
-            cls = _find_item_subclass(self.itemtype, id)
-            if cls is not None: yield cls(id, __class__=cls)
+        query = Container(self.itemtype, self.folder, self.criteria+criteria)
+        query.pagesize = self.pagesize
+        query.readahead = self.readahead
+        return query
+
+    def _ids(self):
+        _before_query()
+        itemtype, fid, criteria = self.itemtype, self.folder.id, self.criteria
+        if text_index is not None:
+            criteria, tests = text_index.split(criteria, fid)
+            if tests:
+                return _filter_ids(
+                    _folder_items(itemtype, self.folder, criteria), tests
+                )
+        return _folder_items(itemtype, self.folder, criteria)
 
     def __gt__(self, value):
         return self._query("GT", self.encode(value))
@@ -407,6 +1088,27 @@ class Container(object):
     def __neg__(self):
         return self._query("vd")
 
+    def between(self, lo, hi):
+        """Items with values from `lo` up to (but not including) `hi`
+
+        Unless a ``RangeIndex`` answers the query, only the lower bound is sent
+        to Ecco, and the upper one is checked locally.
+        """
+        return self._query("GE", self.encode(lo), "LT", self.encode(hi))
+
+    def min(self):
+        """The smallest value of the items, or None if there are none"""
+        return self._extreme("va")
+
+    def max(self):
+        """The largest value of the items, or None if there are none"""
+        return self._extreme("vd")
+
+    def _extreme(self, sort):
+        item = self._query(sort).first()
+        if item is not None:
+            return self.folder.decode(_get_value(int(item), self.folder.id))
+
 
     def __repr__(self):
         return "Container(%s, %r, %r)" % (self.itemtype.__name__, self.folder, self.criteria)
@@ -415,13 +1117,57 @@ class Container(object):
         """Look up item by unique key, and create if non-existent"""
         item = self.get(__key)
         if item is None:
+            name = _attribute_for(self.itemtype, self.folder)
+            if name is not None:
+                defaults.setdefault(name, __key)    # set key on creation
+                return self.itemtype(text, **defaults)
             item = self.itemtype(text, **defaults)
             self.folder.__set__(item, __key)
         return item
 
+    def index(self):
+        """Return a ``KeyIndex`` for this container, creating it if needed
+
+        Once created, the index is used by the ``get()``, ``setdefault()``,
+        ``[]`` and ``in`` operations of all containers for the same item type
+        and folder, until its ``drop()`` method is called.
+        """
+        indexes = _key_indexes.setdefault(self.folder.id, [])
+        for index in indexes:
+            if index.itemtype is self.itemtype:
+                return index
+        index = KeyIndex(self.itemtype, self.folder)
+        indexes.append(index)
+        return index
+
+    def range_index(self):
+        """Return a ``RangeIndex`` for this container, creating it if needed
+
+        Once created, the index is used to find the items of all containers
+        for the same item type and folder whose criteria it can handle, until
+        its ``drop()`` method is called.
+        """
+        indexes = _range_indexes.setdefault(self.folder.id, [])
+        for index in indexes:
+            if index.itemtype is self.itemtype:
+                return index
+        index = RangeIndex(self.itemtype, self.folder)
+        indexes.append(index)
+        return index
+
+    def _index(self):
+        if not self.criteria:
+            for index in _key_indexes.get(self.folder.id, ()):
+                if index.itemtype is self.itemtype:
+                    return index
+
     def get(self, key, default=None):
         """Look up item by unique key, or return default"""
-        items = list(self==key)
+        index = self._index()
+        if index is not None:
+            return index.get(key, default)
+        query = self==key
+        items = list(_first_items(self.itemtype, query._ids(), 2))
         if len(items)>1:
             raise KeyError("Multiple items for", key)
         if items:
@@ -429,7 +1175,9 @@ class Container(object):
         return default
 
     def __getitem__(self, key):
-        """Look up item by unique key"""
+        """Look up item by unique key (or list the items in a slice)"""
+        if isinstance(key, slice):
+            return _ItemQuery.__getitem__(self, key)
         item = self.get(key)
         if item is None:
             raise KeyError(key)
@@ -437,14 +1185,829 @@ class Container(object):
 
     def __contains__(self, __key):
         """Does at least one item exist with the given value?"""
-        for item in (self==__key):
+        index = self._index()
+        if index is not None:
+            return __key in index
+        return (self==__key).exists()
+
+    def where(self, *conditions):
+        """Query for items matching this and `conditions` (see ``Query``)"""
+        return Query(self.itemtype, self, *conditions)
+
+    def sync(self, records, key=None, fields=None, missing=None):
+        """Update, create (and optionally remove) items to match `records`
+
+        `records` is an iterable of dictionaries mapping attribute names to
+        values.  Each record's `key` entry (by default, the name of this
+        container's attribute on the item type) is looked up in this folder to
+        find the corresponding item, which is created if it doesn't exist.
+        Only the `fields` named (by default, all those in each record) are
+        compared and written, and only if they've changed.  Folder attributes
+        and ``text`` can be synced.
+
+        If `missing` is ``"delete"``, items in this container whose key isn't
+        found in `records` are removed from Ecco (via the active session, if
+        any).  If it's the name of a checkmark folder attribute, that folder is
+        unchecked instead, for those of them that are still checked.
+
+        The current keys and values are read in bulk, and the changes are
+        written with one ``SetFolderValues()`` call per distinct set of changed
+        folders (plus one ``SetItemText()`` call), except that new items are
+        created one at a time.  Returns a ``SyncReport``.
+        """
+        itemtype, fid = self.itemtype, self.folder.id
+        attr = _attribute_for(itemtype, self.folder)
+        key = key or attr
+        by_key = {}
+        for record in records:
+            k = self.encode(record[key])
+            if k in by_key:
+                raise KeyError("Multiple records for", record[key])
+            by_key[k] = record
+
+        names = {}
+        for record in by_key.values():
+            names.update(dict.fromkeys(fields or record))
+        names.pop(key, None)
+        folders = {}    # attribute name -> folder
+        for name in names:
+            if name != 'text':
+                descr = getattr(itemtype, name, None)
+                if not isinstance(descr, Container):
+                    raise TypeError("No such folder attribute:", name)
+                folders[name] = descr.folder
+        fids = [fid] + [f.id for f in folders.values()]
+        if missing is not None and missing != 'delete':
+            flag = getattr(itemtype, missing, None)
+            if not isinstance(getattr(flag, 'folder', None), CheckmarkFolder):
+                raise TypeError("Not a checkmark folder:", missing)
+            fids.append(flag.folder.id)
+
+        existing = {}   # raw key -> (item, values, text)
+        _before_query()
+        ids = Ecco.GetFolderItems(fid)
+        pagesize = self.pagesize or len(ids)
+        for start in range(0, len(ids), pagesize or 1):
+            page = ids[start:start+pagesize]
+            texts = 'text' in names and Ecco.GetItemText(page) or page
+            for itemid, (ifids, values), text in zip(
+                page, _fetch_folders(page, fids), texts
+            ):
+                cls = _resolve_subclass(itemtype, ifids, values, itemid)
+                if cls is None:
+                    continue
+                k = values.get(fid, '')
+                if k in existing:
+                    raise KeyError("Multiple items for", self.folder.decode(k))
+                existing[k] = cls(itemid, __class__=cls), values, text
+
+        report = SyncReport()
+        writes = {}     # (changed folder ids) -> ([item ids], [rows])
+        texts = {}
+        for k, record in by_key.items():
+            wanted = [(n, record[n]) for n in names if n in record]
+            if k not in existing:
+                kw = dict(wanted)
+                text = kw.pop('text', record[key])
+                if attr is not None:
+                    kw[attr] = record[key]
+                item = itemtype(str(text), **kw)
+                if attr is None:
+                    self.folder.__set__(item, record[key])
+                report.created.append(item)
+                continue
+            item, values, text = existing[k]
+            changed, row = [], []
+            for name, value in wanted:
+                if name == 'text':
+                    if value != text:
+                        texts[int(item)] = value
+                        changed.append(name)
+                    continue
+                folder = folders[name]
+                raw = folder.encode(value)
+                old = values.get(folder.id, '')
+                if folder.decode(raw) != folder.decode(old):
+                    changed.append(name)
+                    row.append((folder.id, raw))
+            if changed:
+                report.updated.append((item, changed))
+            else:
+                report.unchanged += 1
+            if row:
+                row.sort()
+                wfids = tuple([f for f, v in row])
+                ids, rows = writes.setdefault(wfids, ([], []))
+                ids.append(int(item))
+                rows.append([v for f, v in row])
+
+        for wfids, (ids, rows) in writes.items():
+            _set_many(ids, list(wfids), rows)
+        if texts:
+            Ecco.SetItemText(texts)
+            if cache is not None:
+                cache.texts.update(texts)
+            if text_index is not None:
+                for itemid, text in texts.items():
+                    text_index.set_text(itemid, text)
+
+        if missing == 'delete':
+            gone = [
+                item for k, (item, v, t) in existing.items() if k not in by_key
+            ]
+            if gone:
+                _remove_items(map(int, gone))
+        elif missing is not None:
+            # Only items that are still checked need unchecking
+            gone = [
+                item for k, (item, v, t) in existing.items()
+                    if k not in by_key and v.get(flag.folder.id)
+            ]
+            if gone:
+                _set_many(map(int, gone), [flag.folder.id], [['']]*len(gone))
+        else:
+            gone = []
+        report.removed.extend(gone)
+        return report
+
+
+def _attribute_for(itemtype, folder):
+    """Name of `itemtype`'s attribute for `folder`, or None"""
+    for name in dir(itemtype):
+        descr = getattr(itemtype, name, None)
+        if isinstance(descr, Container) and descr.folder.id == folder.id:
+            return name
+
+
+class SyncReport(object):
+    """The results of a ``Container.sync()``
+
+    ``created`` and ``removed`` are lists of items, ``updated`` is a list of
+    ``(item, [attribute names])`` pairs for items with changes, and
+    ``unchanged`` is the number of items that were already up to date.
+    """
+
+    def __init__(self):
+        self.created = []
+        self.updated = []
+        self.removed = []
+        self.unchanged = 0
+
+    def __repr__(self):
+        return (
+            "<SyncReport: %d created, %d updated, %d removed, %d unchanged>"
+            % (len(self.created), len(self.updated), len(self.removed),
+               self.unchanged)
+        )
+
+
+_sorts = dict.fromkeys(['ia', 'id', 'va', 'vd'])
+
+# Which criteria to prefer sending to Ecco, most selective first
+_selectivity = dict(
+    EQ=0, IB=1, TB=1, GT=2, GE=2, LT=2, LE=2, IC=3, TC=3, NE=4, IN=4, TN=4,
+)
+
+class Query(_ItemQuery):
+    """Find items matching criteria on any number of folders, with a sort
+
+    `conditions` are containers (e.g. ``Task.due < when``, ``+Task.effort``,
+    or ``Task.startswith("x")``), and an item matches if it's in every
+    container's folder and meets all of their criteria.  The last sort
+    specified (if any) determines the order of the results.
+
+    Only the most selective criterion is sent to Ecco; the values needed to
+    check the rest are fetched in bulk for the resulting ids, in batches of
+    ``pagesize`` items, and checked (and sorted) locally.
+    """
+
+    def __init__(self, itemtype, *conditions):
+        self.itemtype = itemtype
+        self.conditions = conditions
+        self.filters = []   # [(folder, [(op, arg)])]
+        self.texts = []     # [(op, arg)] for item text
+        self.added_texts = []   # the subset added by startswith(), etc.
+        self.sort = None    # (folder, op)
+        for cond in conditions:
+            self._add(cond.folder, cond.criteria)
+        if not self.filters:
+            self._add(itemtype._query().folder, ())
+
+    def _add(self, folder, criteria):
+        criteria = list(criteria)
+        tests = []
+        while criteria:
+            op = criteria.pop(0)
+            if op in _sorts:
+                self.sort = folder, op
+            elif op[0]=='I':
+                self.texts.append((op, criteria.pop(0)))
+            else:
+                tests.append((op, criteria.pop(0)))
+        self.filters.append((folder, tests))
+
+    def where(self, *conditions):
+        """Return a query that also requires `conditions`"""
+        query = Query(self.itemtype, *self.conditions+conditions)
+        query.added_texts = list(self.added_texts)
+        query.texts[:0] = self.added_texts
+        query.pagesize = self.pagesize
+        query.readahead = self.readahead
+        return query
+
+    def _text(self, op, value):
+        query = self.where()
+        query.texts.append((op, value))
+        query.added_texts.append((op, value))
+        return query
+
+    def startswith(self, value):
+        return self._text("IB", value)
+    def with_text(self, value):
+        return self._text("IC", value)
+    def without_text(self, value):
+        return self._text("IN", value)
+
+    def __repr__(self):
+        conditions = map(repr, self.conditions)
+        conditions.extend(["%s(%r)" % t for t in self.added_texts])
+        return "Query(%s, %s)" % (
+            self.itemtype.__name__, ', '.join(conditions)
+        )
+
+    def _plan(self):
+        """-> (folder, criteria, local sort?) to send to Ecco, plus the tests
+
+        The tests are a list of ``(folderid, predicate)`` pairs for values, and
+        a list of predicates for item text.  (A folder test with a predicate of
+        None only requires an item to be in the folder.)
+        """
+        best = pushed = None
+        for folder, tests in self.filters:
+            for test in tests:
+                rank = _selectivity[test[0]]
+                if best is None or rank<best:
+                    best, pushed = rank, (folder, test)
+        for test in self.texts:
+            rank = _selectivity[test[0]]
+            if best is None or rank<best:
+                best, pushed = rank, (self.filters[0][0], test)
+        if pushed is None:
+            # No criteria, just membership: let Ecco sort if it can
+            if self.sort and len(self.filters)==1:
+                folder, op = self.sort
+                return folder, (op,), False, [], []
+            pushed = self.filters[0][0], ()
+
+        values, texts = [], []
+        for folder, tests in self.filters:
+            values.append((folder.id, None))  # must be in the folder
+            for test in tests:
+                if (folder, test) != pushed:
+                    values.append((folder.id, _criterion(folder.ftype, *test)))
+        for test in self.texts:
+            if test is not pushed[1]:
+                texts.append(_criterion(None, *test))
+        folder, criteria = pushed
+        return folder, criteria, True, values, texts
+
+    def _ids(self):
+        if text_index is not None:
+            query, tests = self._split_text()
+            if tests:
+                return _filter_ids(query._ids(), tests)
+        _before_query()
+        folder, criteria, local_sort, tests, texts = self._plan()
+        ids = _folder_items(self.itemtype, folder, criteria)
+        sort = local_sort and self.sort
+        fids = dict([(fid, True) for fid, test in tests if fid!=folder.id])
+        if sort and sort[1][0]=='v':
+            fids[sort[0].id] = True
+            tests.append((sort[0].id, None))
+        tests = [(fid, test) for fid, test in tests if fid in fids or test]
+        if not tests and not texts and not sort:
+            return ids
+
+        fids = fids.keys()
+        if folder.id not in fids and [t for t in tests if t[0]==folder.id]:
+            fids.append(folder.id)
+        want_text = texts or sort and sort[1][0]=='i'
+
+        result = []
+        pagesize = self.pagesize or len(ids)
+        for start in range(0, len(ids), pagesize or 1):
+            page = ids[start:start+pagesize]
+            rows = fids and Ecco.GetFolderValues(page, fids) or [()]*len(page)
+            text = want_text and Ecco.GetItemText(page) or page
+            for itemid, row, text in zip(page, rows, text):
+                row = dict(zip(fids, row))
+                for fid, test in tests:
+                    if not row[fid] or test is not None and not test(row[fid]):
+                        break
+                else:
+                    for test in texts:
+                        if not test(text):
+                            break
+                    else:
+                        result.append((itemid, row, text))
+
+        if sort:
+            folder, op = sort
+            if op[0]=='i':
+                key = lambda r: r[2].lower()
+            else:
+                fid, convert = folder.id, _sort_key(folder.ftype)
+                key = lambda r: convert(r[1][fid])
+            result.sort(key=key, reverse=op[1]=='d')
+        return [r[0] for r in result]
+
+    def _split_text(self):
+        """-> (copy of this query without indexed text criteria, [tests])"""
+        query = Query.__new__(Query)
+        query.__dict__.update(self.__dict__)
+        query.texts, query.filters = [], []
+        tests = [text_index.test(op, arg) for op, arg in self.texts]
+        for folder, criteria in self.filters:
+            kept = []
+            for op, arg in criteria:
+                if text_index.covers(op, folder.id):
+                    tests.append(text_index.test(op, arg, folder.id))
+                else:
+                    kept.append((op, arg))
+            query.filters.append((folder, kept))
+        return query, tests
+
+
+
+
+_key_indexes = {}   # folderid -> [KeyIndex]
+
+class KeyIndex(object):
+    """Local lookup table from a folder's values to the items having them
+
+    The folder values of all the items in `folder` that are of type `itemtype`
+    are loaded in bulk when the index is created (or ``refresh()``-ed).  A
+    ``KeyError`` is raised at that point if any value is shared by more than
+    one item.  Values are compared the way Ecco compares them for an "EQ"
+    query, so that e.g. ``42`` finds a number stored as ``"42.0"``.  Writes and
+    item creation done through this module keep the index up to date; changes
+    made by other means require a ``refresh()``.
+    """
+
+    def __init__(self, itemtype, folder):
+        self.itemtype = itemtype
+        self.folder = folder
+        self.key = _sort_key(folder.ftype)
+        self.refresh()
+
+    def refresh(self):
+        """Reload the index from Ecco"""
+        self.keys = {}      # normalized value -> [itemids]
+        self.items = {}     # itemid -> (class, raw value)
+        fid = self.folder.id
+        _before_query()
+        ids = Ecco.GetFolderItems(fid)
+        pagesize = Container.pagesize
+        for start in range(0, len(ids), pagesize):
+            page = ids[start:start+pagesize]
+            states = _fetch_folders(page, [fid])
+            for itemid, (fids, values) in zip(page, states):
+                cls = _resolve_subclass(self.itemtype, fids, values, itemid)
+                if cls is not None:
+                    self._add(itemid, cls, values.get(fid, ''))
+        for ids in self.keys.values():
+            if len(ids)>1:
+                raw = self.items[ids[0]][1]
+                raise KeyError("Multiple items for", self.folder.decode(raw))
+
+    def drop(self):
+        """Stop using (and updating) this index"""
+        _key_indexes[self.folder.id].remove(self)
+
+    def _normalize(self, raw):
+        # The form in which raw value `raw` is compared to others
+        try:
+            return self.key(raw)
+        except ArithmeticError:
+            return raw
+
+    def _add(self, itemid, cls, key):
+        self.items[itemid] = cls, key
+        if key:
+            self.keys.setdefault(self._normalize(key), []).append(itemid)
+
+    def _remove(self, itemid, key):
+        if key:
+            key = self._normalize(key)
+            self.keys[key].remove(itemid)
+            if not self.keys[key]:
+                del self.keys[key]
+
+    def update(self, itemid, key, cls=None):
+        """Note that `itemid` (of class `cls`, if known) now has value `key`"""
+        if itemid in self.items:
+            cls, old = self.items[itemid]
+            self._remove(itemid, old)
+        elif not key:
+            return
+        elif cls is None or not issubclass(cls, self.itemtype):
+            cls = _find_item_subclass(self.itemtype, itemid)
+            if cls is None:
+                return
+        self._add(itemid, cls, key)
+
+    def forget(self, itemid):
+        """Remove `itemid` from the index (e.g. because it was deleted)"""
+        if itemid in self.items:
+            cls, key = self.items.pop(itemid)
+            self._remove(itemid, key)
+
+    def get(self, key, default=None):
+        """Look up item by unique key, or return default"""
+        ids = self.keys.get(self._normalize(self.folder.encode(key)))
+        if not ids:
+            return default
+        elif len(ids)>1:
+            raise KeyError("Multiple items for", key)
+        cls = self.items[ids[0]][0]
+        return cls(ids[0], __class__=cls)
+
+    def __contains__(self, key):
+        return self._normalize(self.folder.encode(key)) in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __repr__(self):
+        return "KeyIndex(%s, %r)" % (self.itemtype.__name__, self.folder)
+
+
+_range_indexes = {} # folderid -> [RangeIndex]
+
+class RangeIndex(object):
+    """Sorted local copy of a folder's values, for range queries and sorts
+
+    The values of all the items in `folder` that are of type `itemtype` are
+    loaded in bulk when the index is created (or ``refresh()``-ed), and kept
+    in order.  Containers for the same item type and folder whose criteria are
+    all comparisons and value sorts (including ``between()``, ``min()`` and
+    ``max()``) are then answered by binary search, instead of by Ecco.  Dates
+    are ordered as ``MemoryEcco`` orders them, with a date comparing equal to
+    midnight on that day; real Ecco's ordering hasn't been verified.  Writes
+    and item creation done through this module keep the index up to date;
+    changes made by other means require a ``refresh()``.
+    """
+
+    def __init__(self, itemtype, folder):
+        self.itemtype = itemtype
+        self.folder = folder
+        self.key = _sort_key(folder.ftype)
+        self.refresh()
+
+    def refresh(self):
+        """Reload the index from Ecco"""
+        fid = self.folder.id
+        _before_query()
+        ids = Ecco.GetFolderItems(fid)
+        if _accepts_all(self.itemtype):
+            rows = zip(ids, ids and Ecco.GetFolderValues(ids, fid) or [])
+        else:
+            rows = []
+            pagesize = Container.pagesize
+            for start in range(0, len(ids), pagesize):
+                page = ids[start:start+pagesize]
+                states = _fetch_folders(page, [fid])
+                for itemid, (fids, values) in zip(page, states):
+                    cls = _resolve_subclass(
+                        self.itemtype, fids, values, itemid
+                    )
+                    if cls is not None:
+                        rows.append((itemid, values.get(fid, '')))
+        entries = [(self.key(raw), itemid) for itemid, raw in rows if raw]
+        entries.sort()
+        self.keys = [key for key, itemid in entries]    # sorted values
+        self.ids = [itemid for key, itemid in entries]  # ids, in same order
+        self.items = dict([(itemid, key) for key, itemid in entries])
+
+    def drop(self):
+        """Stop using (and updating) this index"""
+        _range_indexes[self.folder.id].remove(self)
+
+    def update(self, itemid, raw, cls=None):
+        """Note that `itemid` (of class `cls`, if known) now has value `raw`"""
+        keys, ids = self.keys, self.ids
+        if itemid in self.items:
+            pos = self._find(self.items.pop(itemid), itemid)
+            del keys[pos], ids[pos]
+        elif not raw:
+            return
+        elif cls is None or not issubclass(cls, self.itemtype):
+            if _find_item_subclass(self.itemtype, itemid) is None:
+                return
+        if raw:
+            key = self.items[itemid] = self.key(raw)
+            pos = self._find(key, itemid)
+            keys.insert(pos, key)
+            ids.insert(pos, itemid)
+
+    def forget(self, itemid):
+        """Remove `itemid` from the index (e.g. because it was deleted)"""
+        if itemid in self.items:
+            pos = self._find(self.items.pop(itemid), itemid)
+            del self.keys[pos], self.ids[pos]
+
+    def _find(self, key, itemid):
+        # Position of `itemid` among the entries for `key`, which are in id
+        # order (as Ecco leaves items with equal values when sorting)
+        lo = bisect.bisect_left(self.keys, key)
+        hi = bisect.bisect_right(self.keys, key)
+        return lo + bisect.bisect_left(self.ids[lo:hi], itemid)
+
+    def select(self, criteria):
+        """List the ids matching GetFolderItems `criteria`, or None
+
+        None is returned if any of the criteria aren't comparisons or value
+        sorts.  Without a sort, ids are listed in ascending order.
+        """
+        criteria = list(criteria)
+        lower = upper = None    # (key, exclusive?), (key, inclusive?)
+        exclude, sort = {}, None
+        while criteria:
+            op = criteria.pop(0)
+            if op in ('va', 'vd'):
+                sort = op
+                continue
+            elif op not in _comparisons:
+                return None
+            key = self.key(str(criteria.pop(0)))
+            if op in ('GT', 'GE', 'EQ'):
+                bound = key, op=='GT'
+                if lower is None or bound>lower:
+                    lower = bound
+            if op in ('LT', 'LE', 'EQ'):
+                bound = key, op!='LT'
+                if upper is None or bound<upper:
+                    upper = bound
+            if op=='NE':
+                exclude[key] = True
+
+        keys = self.keys
+        start, stop = 0, len(keys)
+        if lower is not None:
+            if lower[1]:
+                start = bisect.bisect_right(keys, lower[0])
+            else:
+                start = bisect.bisect_left(keys, lower[0])
+        if upper is not None:
+            if upper[1]:
+                stop = bisect.bisect_right(keys, upper[0])
+            else:
+                stop = bisect.bisect_left(keys, upper[0])
+        entries = zip(keys[start:stop], self.ids[start:stop])
+        if exclude:
+            entries = [e for e in entries if e[0] not in exclude]
+        if sort is None:
+            ids = [itemid for key, itemid in entries]
+            ids.sort()
+        else:
+            if sort=='vd':
+                # descending values, but equal values stay in id order
+                entries.sort(key=operator.itemgetter(0), reverse=True)
+            ids = [itemid for key, itemid in entries]
+        return ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __repr__(self):
+        return "RangeIndex(%s, %r)" % (self.itemtype.__name__, self.folder)
+
+
+def _folder_items(itemtype, folder, criteria):
+    """``GetFolderItems(folder, *criteria)``, using a `RangeIndex` if possible
+
+    Without an index, only the first value comparison is sent to Ecco, which
+    isn't relied on to combine several (as in a ``between()`` range).  The
+    rest are checked locally, against values fetched in bulk.
+    """
+    fid = folder.id
+    for index in _range_indexes.get(fid, ()):
+        if index.itemtype is itemtype:
+            ids = index.select(criteria)
+            if ids is not None:
+                return ids
+    sent, tests, criteria = [], [], list(criteria)
+    while criteria:
+        op = criteria.pop(0)
+        if op in _sorts:
+            sent.append(op)
+            continue
+        arg = criteria.pop(0)
+        if op in _comparisons and [o for o in sent if o in _comparisons]:
+            tests.append(_criterion(folder.ftype, op, arg))
+        else:
+            sent.extend([op, arg])
+    ids = Ecco.GetFolderItems(fid, *sent)
+    if not tests or not ids:
+        return ids
+    result, pagesize = [], Container.pagesize
+    for start in range(0, len(ids), pagesize):
+        page = ids[start:start+pagesize]
+        for itemid, value in zip(page, Ecco.GetFolderValues(page, fid)):
+            for test in tests:
+                if not test(value):
+                    break
+            else:
+                result.append(itemid)
+    return result
+
+
+class TextIndex(object):
+    """Local index of item text (and text folder values) for text searches
+
+    While an index is active (see ``begin()``), the "begins with", "contains"
+    and "doesn't contain" criteria of containers and queries (``startswith()``,
+    ``with_text()`` and ``without_text()``, on item classes or on the folders
+    given as `folders`) are answered from memory, instead of by having Ecco
+    scan the text of every item in the folder.  Other criteria and sorts are
+    still sent to Ecco, and the resulting ids are then filtered locally.
+
+    The text of every item, and the values of `folders`, are loaded in bulk the
+    first time they're needed, and loaded again after ``refresh()``.  Writes,
+    item creation and deletion done through this module keep the index up to
+    date; changes made by other means require a ``refresh()``.
+    """
+
+    loaded = False
+
+    def __init__(self, *folders):
+        self.folders = [int(getattr(f, 'folder', f)) for f in folders]
+        self.previous = []
+
+    def begin(self):
+        """Make this the active text index, until ``end()`` is called"""
+        global text_index
+        self.previous.append(text_index)
+        text_index = self
+        return self
+
+    def end(self):
+        """Restore whatever text index was active before ``begin()``"""
+        global text_index
+        text_index = self.previous.pop()
+
+    __enter__ = begin
+
+    def __exit__(self, typ, val, tb):
+        self.end()
+
+    def refresh(self):
+        """Forget the loaded text, so it's reloaded when next needed"""
+        self.loaded = False
+
+    def load(self):
+        """Load item text and folder values from Ecco, if needed; return self
+
+        The text of all items takes one ``GetItemSubs()`` call plus one
+        ``GetItemText()`` call per page of items, and each folder takes one
+        ``GetFolderItems()`` and one ``GetFolderValues()`` call.
+        """
+        if not self.loaded:
+            _before_query()
+            self.texts = {}     # source -> {itemid: lowercased text}
+            self.grams = {}     # source -> {trigram: {itemid: True}}
+            self.sorted = {}    # source -> sorted [(lowercased text, itemid)]
+            ids = [itemid for depth, itemid in Ecco.GetItemSubs(0, 0)]
+            pagesize = _ItemQuery.pagesize
+            texts = []
+            for start in range(0, len(ids), pagesize):
+                texts.extend(Ecco.GetItemText(ids[start:start+pagesize]))
+            self._load(None, ids, texts)
+            for fid in self.folders:
+                ids = Ecco.GetFolderItems(fid)
+                self._load(fid, ids, ids and Ecco.GetFolderValues(ids, fid))
+            self.loaded = True
+        return self
+
+    def _load(self, source, ids, texts):
+        texts = self.texts[source] = dict([
+            (itemid, text.lower()) for itemid, text in zip(ids, texts) if text
+        ])
+        grams = self.grams[source] = {}
+        for itemid, text in texts.items():
+            for gram in _trigrams(text):
+                grams.setdefault(gram, {})[itemid] = True
+        ordered = [(text, itemid) for itemid, text in texts.items()]
+        ordered.sort()
+        self.sorted[source] = ordered
+
+    def _set(self, source, itemid, text):
+        texts, grams, ordered = (
+            self.texts[source], self.grams[source], self.sorted[source]
+        )
+        old = texts.pop(itemid, None)
+        if old is not None:
+            for gram in _trigrams(old):
+                del grams[gram][itemid]
+                if not grams[gram]:
+                    del grams[gram]
+            del ordered[bisect.bisect_left(ordered, (old, itemid))]
+        if text:
+            text = texts[itemid] = text.lower()
+            for gram in _trigrams(text):
+                grams.setdefault(gram, {})[itemid] = True
+            bisect.insort(ordered, (text, itemid))
+
+    def set_text(self, itemid, text):
+        """Note that `itemid` now has `text`"""
+        if self.loaded:
+            self._set(None, itemid, text)
+
+    def update(self, itemid, fids, values):
+        """Note that `itemid` now has raw `values` for `fids`"""
+        if self.loaded:
+            for fid, value in zip(fids, values):
+                if fid in self.texts:
+                    self._set(fid, itemid, value)
+
+    def forget(self, itemid):
+        """Note that `itemid` has been deleted"""
+        if self.loaded:
+            for source in self.texts:
+                self._set(source, itemid, '')
+
+    def covers(self, op, fid=None):
+        """Can the index answer criterion `op` on `fid` (or on item text)?"""
+        if op[0]=='I':
             return True
-        return False
+        return op[0]=='T' and fid in self.folders
+
+    def search(self, op, arg, fid=None):
+        """Dictionary of the ids whose text (or `fid` value) matches `op`
+
+        `op` is a "begins with" or "contains" criterion (like ``"IB"`` or
+        ``"TC"``); for "doesn't contain", search for "contains" instead and
+        exclude the results.
+        """
+        if op[0]=='I':
+            fid = None
+        self.load()
+        arg, texts = str(arg).lower(), self.texts[fid]
+        if op[1]=='B':
+            ordered = self.sorted[fid]
+            found = {}
+            pos, end = bisect.bisect_left(ordered, (arg,)), len(ordered)
+            while pos<end:
+                text, itemid = ordered[pos]
+                if not text.startswith(arg):
+                    break
+                found[itemid] = True
+                pos += 1
+            return found
+        grams = _trigrams(arg)
+        if not grams:
+            candidates = texts
+        else:
+            candidates = None
+            for gram in grams:
+                ids = self.grams[fid].get(gram, {})
+                if candidates is None or len(ids)<len(candidates):
+                    candidates = ids
+        return dict([(i, True) for i in candidates if arg in texts[i]])
+
+    def test(self, op, arg, fid=None):
+        """Return a predicate for item ids meeting criterion `op`"""
+        found = self.search(op[0] + op[1].replace('N', 'C'), arg, fid)
+        if op[1]=='N':
+            return lambda itemid: itemid not in found
+        return found.has_key
+
+    def split(self, criteria, fid):
+        """Split GetFolderItems `criteria` into ``(criteria, tests)``
+
+        Returns the criteria that must still be sent to Ecco for `fid`, and a
+        list of predicates on item ids for the ones the index can answer.
+        """
+        criteria, rest, tests = list(criteria), [], []
+        while criteria:
+            op = criteria.pop(0)
+            if op in _sorts:
+                rest.append(op)
+            elif self.covers(op, fid):
+                tests.append(self.test(op, criteria.pop(0), fid))
+            else:
+                rest.extend([op, criteria.pop(0)])
+        return rest, tests
+
+
+def _trigrams(text):
+    return dict.fromkeys([text[i:i+3] for i in range(len(text)-2)]).keys()
 
-    def __and__(self, other):  return intersect(self, other)
-    def __rand__(self, other): return intersect(other, self)
-    def __or__(self, other):  return union(self, other)
-    def __ror__(self, other): return union(other, self)
+def _filter_ids(ids, tests):
+    """List the `ids` for which all of `tests` are true"""
+    for test in tests:
+        ids = filter(test, ids)
+    return ids
 
 
 
@@ -454,12 +2017,12 @@ class FolderClass(type):
 
     def __iter__(self):
         ftype = self.ftype
-        for fid, depth in Ecco.GetFolderOutline():
-            if ftype is None or Ecco.GetFolderType(fid)==ftype:
+        for fid, depth in _folder_outline():
+            if ftype is None or _folder_type(fid)==ftype:
                 yield self(fid)
 
     def __contains__(self, f):
-        return Ecco.GetFolderType(int(f))==(self.ftype or FolderType.CheckMark)
+        return _folder_type(int(f))==(self.ftype or FolderType.CheckMark)
 
    
 
@@ -499,20 +2062,22 @@ class Folder(object):
         if create and self.ftype is None:
             raise TypeError("You can only create Folder subclasses")
         if isinstance(name_or_id, basestring):
-            fids = Ecco.GetFoldersByName(name_or_id)
+            fids = _folders_by_name(name_or_id)
             self.name = name_or_id
             if not fids:
                 if create:
                     self.id = Ecco.CreateFolder(name_or_id, self.ftype)
+                    if schema is not None:
+                        schema.refresh()
                 else:
                     raise KeyError(name_or_id)
             else:
                 self.id, = fids
         else:
             self.id = name_or_id
-            self.name = Ecco.GetFolderName(self.id)
+            self.name = _folder_name(self.id)
 
-        ftype = Ecco.GetFolderType(self.id)
+        ftype = _folder_type(self.id)
         if self.ftype is None:
             self.__class__ = folder_classes[ftype]
         elif ftype != self.ftype:
@@ -521,15 +2086,15 @@ class Folder(object):
             )
 
     def __set__(self, ob, value):
-        Ecco.SetFolderValues(int(ob), self.id, self.encode(value))
+        _set_values(int(ob), [self.id], [self.encode(value)])
 
     def __get__(self, ob, typ=None):
         if ob is None:
             return Container(typ, self)
-        return self.decode(Ecco.GetFolderValues(int(ob), self.id))
+        return self.decode(_get_value(int(ob), self.id))
 
     def __delete__(self, ob):
-        Ecco.SetFolderValues(int(ob), self.id, '')
+        _set_values(int(ob), [self.id], [''])
 
     decorate(staticmethod)
     def encode(value):
@@ -540,22 +2105,32 @@ class Folder(object):
     def decode(value):
         return value
 
+    def decode_many(self, values):
+        """Decode a list of raw values, decoding each distinct value once"""
+        decode = self.decode
+        decoded = dict([(v, decode(v)) for v in dict.fromkeys(values)])
+        return map(decoded.__getitem__, values)
+
+    def decode_array(self, values, numpy, exact=False):
+        """Decode a list of raw values as a NumPy array (see ``columns()``)"""
+        return numpy.array(self.decode_many(values), dtype=object)
+
     def __getitem__(self, key):
         """cls->Container or item->value"""
         if isinstance(key, ItemClass):
             return Container(key, self)
         if isinstance(key, int):
-            return self.decode(Ecco.GetFolderValues(int(key), self.id))
+            return self.decode(_get_value(int(key), self.id))
         raise TypeError, key
 
     def __setitem__(self, key, value):
         if isinstance(key, int):
-            return Ecco.SetFolderValues(int(key), self.id, self.encode(value))
+            return _set_values(int(key), [self.id], [self.encode(value)])
         raise TypeError, key
 
     def __contains__(self, item):
         """Is item in this folder?"""
-        return self.id in Ecco.GetItemFolders(int(item))
+        return self.id in _item_folders(int(item))
 
     def __repr__(self):
         return "%s(%r)" % (self.__class__.__name__, self.name)
@@ -590,6 +2165,12 @@ class CheckmarkFolder(Folder):
     def decode(value):
         return bool(value)
 
+    def decode_many(self, values):
+        return map(bool, values)
+
+    def decode_array(self, values, numpy, exact=False):
+        return numpy.array(map(bool, values), dtype=bool)
+
 class DateFolder(Folder):
     ftype = FolderType.Date
 
@@ -612,21 +2193,43 @@ class DateFolder(Folder):
         value = value[8:]
         return datetime.datetime(y,m,d, int(value[:2]), int(value[2:4]))
 
+    def decode_array(self, values, numpy, exact=False):
+        # Days, unless there are any times, in which case use minutes
+        unit, iso = 'D', []
+        for v in values:
+            if not v:
+                iso.append('NaT')
+            elif len(v)==8:
+                iso.append('%s-%s-%s' % (v[:4], v[4:6], v[6:8]))
+            else:
+                unit = 'm'
+                iso.append('%s-%s-%sT%s:%s' % (
+                    v[:4], v[4:6], v[6:8], v[8:10], v[10:12]
+                ))
+        return numpy.array(iso, dtype='datetime64[%s]' % unit)
+
 
 class NumericFolder(Folder):
     ftype = FolderType.Number
 
-    def encode(self, value):
+    decorate(staticmethod)
+    def encode(value):
         if value is None: return ''
         return str(Decimal(value))
 
-    def decode(self, value):
+    decorate(staticmethod)
+    def decode(value):
         if not value:
             return None
         if '.' in value:
             return Decimal(value)
         return int(value)
 
+    def decode_array(self, values, numpy, exact=False):
+        if exact:
+            return Folder.decode_array(self, values, numpy)
+        return numpy.array([float(v or 'nan') for v in values], dtype=float)
+
 
 folder_classes = [
     TextFolder, PopupFolder, CheckmarkFolder, DateFolder, NumericFolder
@@ -637,9 +2240,14 @@ folder_decoders = dict([(t, f.decode) for t,f in folder_classes.items()])
 
 def all_folders():
     """Return a mapping of folder ids to (parentid,[childids]) pairs"""
+    if schema is not None:
+        return schema.load().tree
+    return _folder_tree(Ecco.GetFolderOutline())
+
+def _folder_tree(outline):
     info, stack = {}, []
     parent, children = None, []
-    for fid, depth in Ecco.GetFolderOutline():
+    for fid, depth in outline:
         while depth<len(stack):
             parent, children = stack.pop()
             #ignore, children = info[parent]
@@ -654,85 +2262,2134 @@ def all_folders():
 
 
 
-def _find_item_subclass(cls, itemid=None, data=(), required=False):
-    get = _folder_bits.get
-    mask, values = 0, []
-    if itemid is not None:
-        fids = Ecco.GetItemFolders(itemid)
-        for fid in fids:
-            bit = get(fid, 0)
-            if bit:
-                values.append(fid)
-                mask |= bit
-        values = dict(zip(values, Ecco.GetFolderValues(itemid, values)))
-    else:
-        values = {}
-    if data:
-        values.update(data)
-        mask |= reduce(operator.or_, [get(fid,0) for fid,val in data], 0)
+class FolderSchema(object):
+    """Keep the folder outline, names and types, to serve lookups locally
 
-    matches = []
-    match = None
-    candidates = [cls]
-    while True:
-        for subclass in candidates:
-            m = subclass._folder_mask
-            if (mask & m)!=m or (mask & subclass._exclusion_mask):
-                continue
-            for k, v in subclass._required_values.iteritems():
-                if v!=values[k] and v is not None:
-                    break
-            else:
-                if subclass._validate_fields(values):
-                    matches.append(subclass)
-        if matches:
-            if len(matches)>1:
-                raise TypeError("Validation ambiguity:",itemid or None,matches)
-            match = matches.pop()
-            candidates = [c for c in match.__subclasses__() if '_validate_fields' in c.__dict__]
-        elif match is None and required:
-            raise TypeError # XXX error message
-        else:
-            return match
+    While a schema is active (see ``begin()``), ``all_folders()``, looking up
+    folders by name or id, and iterating over folder classes are answered from
+    memory, instead of asking Ecco about each folder in turn.  Everything is
+    loaded with three calls the first time it's needed, and loaded again after
+    ``refresh()``.  Creating a folder through this module refreshes the schema
+    automatically, but folders added, renamed or moved by other means won't be
+    noticed until you call ``refresh()`` yourself.
+    """
 
-def additional_tests():
-    import doctest
-    return doctest.DocFileSuite(
-        'README.txt',
-        optionflags=doctest.ELLIPSIS|doctest.NORMALIZE_WHITESPACE,
-    )
+    outline = None
 
+    def __init__(self):
+        self.previous = []
 
+    def begin(self):
+        """Make this the active schema, until ``end()`` is called"""
+        global schema
+        self.previous.append(schema)
+        schema = self
+        return self
 
+    def end(self):
+        """Restore whatever schema was active before ``begin()``"""
+        global schema
+        schema = self.previous.pop()
+
+    __enter__ = begin
+
+    def __exit__(self, typ, val, tb):
+        self.end()
+
+    def refresh(self):
+        """Forget the loaded schema, so it's reloaded when next needed"""
+        self.outline = None
+
+    def load(self):
+        """Load the schema from Ecco, if needed; return `self`"""
+        if self.outline is None:
+            outline = Ecco.GetFolderOutline()
+            fids = [fid for fid, depth in outline]
+            self.names = dict(zip(fids, Ecco.GetFolderName(fids)))
+            self.types = dict(zip(fids, Ecco.GetFolderType(fids)))
+            self.by_name = {}
+            for fid in fids:
+                self.by_name.setdefault(self.names[fid], []).append(fid)
+            self.tree = _folder_tree(outline)
+            self.outline = outline
+        return self
 
 
+def _folder_outline():
+    if schema is not None:
+        return schema.load().outline
+    return Ecco.GetFolderOutline()
+
+def _folders_by_name(name):
+    if schema is not None:
+        return list(schema.load().by_name.get(name, ()))
+    return Ecco.GetFoldersByName(name)
+
+def _folder_name(fid):
+    if schema is not None:
+        names = schema.load().names
+        if fid in names:
+            return names[fid]
+    return Ecco.GetFolderName(fid)
+
+def _folder_type(fid):
+    if schema is not None:
+        types = schema.load().types
+        if fid in types:
+            return types[fid]
+    return Ecco.GetFolderType(fid)
+
+
+class OutlineSnapshot(object):
+    """Parents and children of every item, loaded from Ecco in one call
+
+    The whole item outline is read with a single ``GetItemSubs()`` call the
+    first time it's needed, after which parents, children, depths, ancestors
+    and subtrees are all answered from memory.  While a snapshot is active (see
+    ``begin()``), it also backs the ``Parent`` and ``Children`` attributes of
+    items.  Moving, creating or deleting items through this module discards
+    the snapshot so it's reloaded on next use, but changes made by other means
+    aren't noticed until ``refresh()`` is called.
+    """
+
+    parents = None
+
+    def __init__(self):
+        self.previous = []
+
+    def begin(self):
+        """Make this the active snapshot, until ``end()`` is called"""
+        global snapshot
+        self.previous.append(snapshot)
+        snapshot = self
+        return self
 
+    def end(self):
+        """Restore whatever snapshot was active before ``begin()``"""
+        global snapshot
+        snapshot = self.previous.pop()
+
+    __enter__ = begin
+
+    def __exit__(self, typ, val, tb):
+        self.end()
+
+    def refresh(self):
+        """Forget the loaded outline, so it's reloaded when next needed"""
+        self.parents = None
+
+    def load(self):
+        """Load the outline from Ecco, if needed; return `self`"""
+        if self.parents is None:
+            _before_query()
+            parents, subs, stack = {}, {0: []}, [0]
+            for depth, itemid in Ecco.GetItemSubs(0, 0):
+                del stack[depth:]
+                parents[itemid] = stack[-1]
+                subs[stack[-1]].append(itemid)
+                subs[itemid] = []
+                stack.append(itemid)
+            self.subs = subs
+            self.parents = parents
+        return self
 
+    def __len__(self):
+        return len(self.load().parents)
 
+    def __contains__(self, item):
+        return int(item) in self.load().parents
+
+    def parent(self, item):
+        """Id of `item`'s parent (0 for a top-level item)"""
+        return self.load().parents[int(item)]
+
+    def children(self, item=0):
+        """List of ids of `item`'s children (top-level items if 0)"""
+        return list(self.load().subs[int(item)])
+
+    def ancestors(self, item):
+        """Root-first list of `item`'s ancestors, like ``GetItemParents()``"""
+        parents, result = self.load().parents, []
+        itemid = parents[int(item)]
+        while itemid:
+            result.append(itemid)
+            itemid = parents[itemid]
+        result.reverse()
+        return result
 
+    def depth(self, item):
+        """Depth of `item` in the outline (1 for top-level items)"""
+        return len(self.ancestors(item)) + 1
+
+    def walk(self, item=0, depth=0):
+        """List ``(depth, id)`` for `item`'s subtree, like ``GetItemSubs()``
+
+        `depth` limits how many levels are included (0 means all of them).
+        """
+        subs, result = self.load().subs, []
+        stack = [(1, sub) for sub in subs[int(item)][::-1]]
+        while stack:
+            d, itemid = stack.pop()
+            result.append((d, itemid))
+            if d != depth:
+                stack.extend([(d+1, sub) for sub in subs[itemid][::-1]])
+        return result
 
+def _outline_changed():
+    if snapshot is not None:
+        snapshot.refresh()
 
 
+class ValueCache(object):
+    """Keep folder values fetched from Ecco, to serve later reads locally
 
+    While a cache is active (see ``begin()``), the folder membership and values
+    that are fetched to determine an item's class are remembered, as are any
+    values read or written through folder attributes, so that reading them
+    again doesn't need another round trip to Ecco.  Values are kept in their
+    raw (encoded) form, keyed by item id.
+    """
 
+    def __init__(self):
+        self.folders = {}   # itemid -> {folderid: True} for all its folders
+        self.values = {}    # itemid -> {folderid: raw value}
+        self.texts = {}     # itemid -> text
+        self.previous = []
 
+    def begin(self):
+        """Make this the active cache, until ``end()`` is called"""
+        global cache
+        self.previous.append(cache)
+        cache = self
+        return self
 
+    def end(self):
+        """Restore whatever cache was active before ``begin()``"""
+        global cache
+        cache = self.previous.pop()
+
+    __enter__ = begin
+
+    def __exit__(self, typ, val, tb):
+        self.end()
+
+    def remember(self, itemid, fids, values):
+        """Record that `itemid` is in `fids` (if not None) and has `values`"""
+        if fids is not None:
+            self.folders[itemid] = dict.fromkeys(fids, True)
+        self.values.setdefault(itemid, {}).update(values)
+
+    def state(self, itemid):
+        """Return ``(folderids, values)`` for `itemid`, if fully known"""
+        folders = self.folders.get(itemid)
+        if folders is not None:
+            get = _folder_bits.get
+            values = self.values.get(itemid, {})
+            for fid in folders:
+                if get(fid) and fid not in values:
+                    return None
+            return folders.keys(), values
+        return None
 
+    def lookup(self, itemid, fid):
+        """Return the raw value of `fid` for `itemid`, or raise KeyError"""
+        values = self.values.get(itemid)
+        if values and fid in values:
+            return values[fid]
+        elif fid not in self.folders.get(itemid, (fid,)):
+            return ''   # known not to be in the folder
+        raise KeyError(itemid, fid)
+
+    def written(self, itemid, fids, values):
+        """Update the cache to reflect writing `values` to `fids`"""
+        folders = self.folders.get(itemid)
+        mine = self.values.setdefault(itemid, {})
+        for fid, value in zip(fids, values):
+            mine[fid] = value
+            if folders is None:
+                continue
+            elif value:
+                folders[fid] = True
+            elif fid in folders:
+                del folders[fid]
+
+    def forget(self, itemid=None):
+        """Discard cached data for `itemid` (or for all items, if None)"""
+        if itemid is None:
+            self.folders.clear()
+            self.values.clear()
+            self.texts.clear()
+        else:
+            self.folders.pop(itemid, None)
+            self.values.pop(itemid, None)
+            self.texts.pop(itemid, None)
 
+    def identity(self, item):
+        """Return the canonical object for a newly-constructed `item`"""
+        return item
 
+    def before_query(self):
+        """Called before fetching item ids or outline info from Ecco"""
+
+    def set_values(self, itemid, fids, values):
+        Ecco.SetFolderValues(itemid, fids, values)
+        self.written(itemid, fids, values)
+
+    def set_many(self, ids, fids, rows):
+        Ecco.SetFolderValues(ids, fids, rows)
+        for itemid, values in zip(ids, rows):
+            self.written(itemid, fids, values)
+
+    def set_text(self, itemid, text):
+        Ecco.SetItemText(itemid, text)
+        self.texts[itemid] = text
+
+    def insert(self, anchor, items, where):
+        Ecco.InsertItem(anchor, items, where)
+
+    def remove(self, ids, doomed):
+        """Delete items `ids`; `doomed` also lists all their descendants"""
+        Ecco.RemoveItem(ids)
+
+
+class Session(ValueCache):
+    """Unit of work: an identity map of items, and batched writes to Ecco
+
+    While a session is active, it caches values like a ``ValueCache``, and
+    keeps one item object per item id.  Writes to folder values, item text and
+    item parents/positions (and deletions by ``Container.sync()``) are recorded
+    instead of being sent to Ecco right away; ``flush()`` sends them using as
+    few API calls as possible.  Writes that don't change an already-known
+    value are dropped.
+
+    If `autoflush` is true (the default), pending writes are flushed before
+    any query that fetches item ids or outline information from Ecco, so that
+    query results reflect the writes.  ``end()`` flushes and deactivates the
+    session, as does leaving a ``with`` block normally.  If the block raises
+    an error, pending writes are discarded instead.
+    """
+
+    autoflush = True
+
+    def __init__(self, autoflush=True):
+        ValueCache.__init__(self)
+        self.autoflush = autoflush
+        self.items = {}         # itemid -> item
+        self.pending = {}       # itemid -> {folderid: raw value}
+        self.pending_text = {}  # itemid -> text
+        self.moves = []         # [(anchor, where, [itemids])]
+        self.removals = []      # [itemid]
+
+    def end(self):
+        """Flush pending writes and deactivate the session"""
+        self.flush()
+        ValueCache.end(self)
+
+    def __exit__(self, typ, val, tb):
+        if typ is None:
+            self.end()
+        else:
+            self.rollback()
+            ValueCache.end(self)
+
+    def identity(self, item):
+        old = self.items.get(int(item))
+        if old is not None and type(old) is type(item):
+            return old
+        self.items[int(item)] = item
+        return item
 
+    def before_query(self):
+        if self.autoflush:
+            self.flush()
+
+    def set_values(self, itemid, fids, values):
+        pending = self.pending.setdefault(itemid, {})
+        for fid, value in zip(fids, values):
+            if fid not in pending:
+                try:
+                    if self.lookup(itemid, fid)==value:
+                        continue    # no change
+                except KeyError:
+                    pass
+            pending[fid] = value
+        if not pending:
+            del self.pending[itemid]
+        self.written(itemid, fids, values)
+
+    def set_many(self, ids, fids, rows):
+        for itemid, values in zip(ids, rows):
+            self.set_values(itemid, fids, values)
+
+    def set_text(self, itemid, text):
+        if itemid in self.pending_text or self.texts.get(itemid)!=text:
+            self.pending_text[itemid] = text
+        self.texts[itemid] = text
+
+    def insert(self, anchor, items, where):
+        self.moves.append((anchor, where, list(items)))
+
+    def remove(self, ids, doomed):
+        for itemid in doomed:
+            self.pending.pop(itemid, None)
+            self.pending_text.pop(itemid, None)
+        self.removals.extend(ids)
+
+    def dirty(self):
+        """True if there are writes waiting to be flushed"""
+        return bool(
+            self.pending or self.pending_text or self.moves or self.removals
+        )
+
+    def rollback(self):
+        """Discard pending writes, and anything cached for affected items"""
+        for itemid in self.pending.keys() + self.pending_text.keys():
+            self.forget(itemid)
+        self.pending.clear()
+        self.pending_text.clear()
+        self.moves = []
+        self.removals = []
+
+    def flush(self):
+        """Send all pending writes to Ecco"""
+        pending, self.pending = self.pending, {}
+        groups = {}
+        for itemid, values in pending.items():
+            fids = values.keys()
+            fids.sort()
+            ids, rows = groups.setdefault(tuple(fids), ([], []))
+            ids.append(itemid)
+            rows.append([values[fid] for fid in fids])
+        for fids, (ids, rows) in groups.items():
+            Ecco.SetFolderValues(ids, list(fids), rows)
+
+        texts, self.pending_text = self.pending_text, {}
+        if texts:
+            Ecco.SetItemText(texts)
+
+        moves, self.moves = self.moves, []
+        for anchor, where, items in _group_moves(moves):
+            Ecco.InsertItem(anchor, items, where)
+
+        removals, self.removals = self.removals, []
+        if removals:
+            Ecco.RemoveItem(removals)
+
+
+def _group_moves(moves):
+    """Coalesce a list of ``(anchor, where, items)`` moves by anchor and level
+
+    Consecutive moves to the same destination are merged, so that each run
+    can be done with one ``InsertItem()`` call.  The order of the moves is
+    otherwise kept, since later moves can depend on where earlier ones put
+    things.  If an item is moved more than once within a run, only its last
+    move is kept.
+    """
+    groups = []
+    for anchor, where, items in moves:
+        if groups and groups[-1][:2]==(anchor, where):
+            groups[-1][2].extend(items)
+        else:
+            groups.append((anchor, where, list(items)))
+    result = []
+    for anchor, where, items in groups:
+        last = dict([(item, n) for n, item in enumerate(items)])
+        items = [item for n, item in enumerate(items) if last[item]==n]
+        result.append((anchor, where, items))
+    return result
+
+
+def _get_value(itemid, fid):
+    """Raw value of `fid` for `itemid`, using the active cache if any"""
+    if cache is not None:
+        try:
+            return cache.lookup(itemid, fid)
+        except KeyError:
+            pass
+    value = Ecco.GetFolderValues(itemid, fid)
+    if cache is not None:
+        cache.remember(itemid, None, {fid: value})
+    return value
+
+def _set_values(itemid, fids, values):
+    """Write raw `values` for `fids` to `itemid`, via the active cache"""
+    if cache is None:
+        Ecco.SetFolderValues(itemid, fids, values)
+    else:
+        cache.set_values(itemid, fids, values)
+    _notify(itemid, fids, values)
 
+def _set_many(ids, fids, rows):
+    """Write `rows` of raw values for `fids` to `ids`, via the active cache
 
+    Without a cache (or with a plain ``ValueCache``), this takes one API call;
+    an active ``Session`` holds the writes until it's flushed, like any other.
+    """
+    if cache is None:
+        Ecco.SetFolderValues(ids, fids, rows)
+    else:
+        cache.set_many(ids, fids, rows)
+    for itemid, values in zip(ids, rows):
+        _notify(itemid, fids, values)
+
+def _notify(itemid, fids, values, cls=None):
+    """Update any indexes for `values` written to `fids` of `itemid`"""
+    for fid, value in zip(fids, values):
+        for index in _key_indexes.get(fid, ()):
+            index.update(itemid, value, cls)
+        for index in _range_indexes.get(fid, ()):
+            index.update(itemid, value, cls)
+    if text_index is not None:
+        text_index.update(itemid, fids, values)
+
+def _remove_items(ids):
+    """Delete items `ids` (and their descendants), via the active cache
+
+    If a cache or any index is active, the outline is read (from the active
+    snapshot, or with one ``GetItemSubs()`` call) to find the descendants, so
+    they can be dropped from the cache and indexes along with the items.
+    """
+    doomed = list(ids)
+    indexes = [1 for v in _key_indexes.values()+_range_indexes.values() if v]
+    if cache is not None or text_index is not None or indexes:
+        subs = (snapshot or OutlineSnapshot()).load().subs
+        stack = list(ids)
+        while stack:
+            children = subs.get(stack.pop(), ())
+            doomed.extend(children)
+            stack.extend(children)
+    if cache is None:
+        Ecco.RemoveItem(ids)
+    else:
+        cache.remove(ids, doomed)
+    _outline_changed()
+    for itemid in doomed:
+        _forget(itemid)
+
+def _forget(itemid):
+    """Drop a deleted `itemid` from the active cache and from all indexes"""
+    for indexes in _key_indexes.values() + _range_indexes.values():
+        for index in indexes:
+            index.forget(itemid)
+    if text_index is not None:
+        text_index.forget(itemid)
+    if cache is not None:
+        cache.forget(itemid)
+
+def _get_text(itemid):
+    if cache is None:
+        return Ecco.GetItemText(itemid)
+    try:
+        return cache.texts[itemid]
+    except KeyError:
+        text = cache.texts[itemid] = Ecco.GetItemText(itemid)
+        return text
 
+def _set_text(itemid, text):
+    if cache is None:
+        Ecco.SetItemText(itemid, text)
+    else:
+        cache.set_text(itemid, text)
+    if text_index is not None:
+        text_index.set_text(itemid, text)
+
+def _insert(anchor, items, where=InsertLevel.Indent):
+    """Move `items` relative to `anchor`, via the active cache"""
+    if not items:
+        return
+    if cache is None:
+        Ecco.InsertItem(anchor, items, where)
+    else:
+        cache.insert(anchor, items, where)
+    _outline_changed()
+
+def _before_query():
+    if cache is not None:
+        cache.before_query()
+
+def _item_folders(itemid):
+    """List of folder ids for `itemid`, using the active cache if any"""
+    if cache is not None and itemid in cache.folders:
+        return cache.folders[itemid].keys()
+    fids = Ecco.GetItemFolders(itemid)
+    if cache is not None:
+        cache.remember(itemid, fids, {})
+    return fids
+
+def _fetch_folders(ids, extra=(), ecco=None):
+    """Bulk-fetch folder info for item `ids` -> [(folderids, values)]
+
+    For each item, `folderids` is the list of folders the item is in, and
+    `values` is a dictionary of the item's values for those of its folders that
+    are used by item classes or listed in `extra`.  Two API calls are made
+    (using `ecco`, if given, instead of the ``Ecco`` global) regardless of the
+    number of items.
+    """
+    if not ids:
+        return []
+    if ecco is None:
+        ecco = Ecco
+    get = _folder_bits.get
+    folders = ecco.GetItemFolders(ids)
+    wanted = dict.fromkeys(extra, True)
+    for fids in folders:
+        for fid in fids:
+            if get(fid, 0): wanted[fid] = True
+    wanted = wanted.keys()
+    if not wanted:
+        if cache is not None:
+            for itemid, fids in zip(ids, folders):
+                cache.remember(itemid, fids, {})
+        return [(fids, {}) for fids in folders]
+    rows = ecco.GetFolderValues(ids, wanted)
+    result = []
+    for itemid, fids, row in zip(ids, folders, rows):
+        row = dict(zip(wanted, row))
+        row = dict([(f, row[f]) for f in fids if f in row])
+        result.append((fids, row))
+        if cache is not None:
+            cache.remember(itemid, fids, row)
+    return result
+
+def _hydrate(cls, ids, pagesize=None, readahead=0, operation=None):
+    """Yield items of type `cls` for `ids`, resolving subclasses in bulk
+
+    `ids` are processed in pages of `pagesize` (all at once if None), so that
+    each page costs a fixed number of API calls.  Ids that don't resolve to a
+    subclass of `cls` are skipped.  If `readahead` is non-zero, pages are
+    fetched by a background thread, up to `readahead` pages ahead of the
+    caller (see ``_ReadAhead``).  `operation` names the public operation that
+    the items are for, so ``Tracer`` can credit the calls to it even after
+    that operation has returned this generator.
+    """
+    ids = list(ids)
+    pagesize = pagesize or len(ids)
+    pages = [
+        ids[start:start+pagesize]
+        for start in range(0, len(ids), pagesize or 1)
+    ]
+    if readahead and len(pages)>1:
+        pages = _ReadAhead(cls, pages, readahead, operation)
+    else:
+        pages = _map_pages(
+            lambda page: _resolve_page(cls, page, None, operation), pages
+        )
+    for page in pages:
+        for sub, itemid in page:
+            yield sub(itemid, __class__=sub)
+
+def _first_items(itemtype, ids, count, pagesize=None):
+    """Yield up to `count` items of `itemtype` for `ids`, in order
+
+    Only as many ids are resolved as are needed: if every id is acceptable,
+    just the first `count`; otherwise, pages starting at `count` ids and
+    doubling in size (up to `pagesize`) until enough items are found.
+    """
+    if _accepts_all(itemtype):
+        ids = ids[:count]
+    start, size = 0, count
+    while start<len(ids) and count>0:
+        size = max(1, min(size, pagesize or len(ids)))
+        for sub, itemid in _resolve_page(itemtype, ids[start:start+size]):
+            yield sub(itemid, __class__=sub)
+            count -= 1
+            if not count:
+                return
+        start += size
+        size *= 2
+
+def _slice_items(itemtype, ids, index, pagesize=None):
+    """List the items of `itemtype` in slice `index` of those for `ids`"""
+    if _accepts_all(itemtype):
+        return list(_hydrate(itemtype, ids[index], pagesize))
+    start, stop, step = index.start or 0, index.stop, index.step or 1
+    if start<0 or stop is None or stop<0 or step<0:
+        return list(_hydrate(itemtype, ids, pagesize))[index]
+    return list(_first_items(itemtype, ids, stop, pagesize))[index]
+
+def _exists(itemtype, ids, pagesize=None):
+    if _accepts_all(itemtype):
+        return bool(ids)
+    for item in _first_items(itemtype, ids, 1, pagesize):
+        return True
+    return False
+
+def _count_items(itemtype, ids, pagesize=None):
+    """Number of `ids` that resolve to `itemtype`, without creating items"""
+    if _accepts_all(itemtype):
+        return len(ids)
+    pagesize = pagesize or len(ids)
+    return sum(_map_pages(
+        lambda page: len(_resolve_page(itemtype, page)), [
+            ids[start:start+pagesize]
+            for start in range(0, len(ids), pagesize or 1)
+        ]
+    ))
+
+def _resolve_page(cls, page, ecco=None, operation=None):
+    """List ``(subclass, itemid)`` for ids in `page` that resolve to `cls`
+
+    `operation` (if given) is the name ``Tracer`` reports for the calls made.
+    """
+    result = []
+    for itemid, (fids, values) in zip(page, _fetch_folders(page, (), ecco)):
+        sub = _resolve_subclass(cls, fids, values, itemid)
+        if sub is not None:
+            result.append((sub, itemid))
+    return result
+
+def _map_pages(func, pages):
+    """Yield ``func(page)`` for `pages`, spread over the active pool if any"""
+    if pool is None or len(pages)<2:
+        for page in pages:
+            yield func(page)
+    else:
+        size = pool.size
+        for start in range(0, len(pages), size):
+            for result in pool.map(func, pages[start:start+size]):
+                yield result
+
+class _ReadAhead(object):
+    """Iterate over ``_resolve_page()`` results computed by another thread
+
+    The thread talks to Ecco over a conversation of its own: a new one from
+    the ``Ecco`` global's ``conversation()`` method if it has one, or else a
+    new instance of its class.  At most `depth` pages are held waiting for
+    the caller, so memory use stays bounded.  Errors in the thread are raised
+    in the caller, and when the iterator is closed or discarded before it's
+    exhausted, the thread is stopped (after any page it's fetching) and
+    waited for.
+    """
+
+    def __init__(self, cls, pages, depth, operation=None):
+        import threading, Queue
+        self.queue = Queue.Queue(depth)
+        self.stop = threading.Event()
+        self.thread = threading.Thread(
+            target=_read_pages,
+            args=(cls, pages, self.queue, self.stop, operation)
+        )
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        import Queue
+        if self.thread is None:
+            raise StopIteration
+        while True:
+            try:
+                done, result = self.queue.get(True, 0.1)
+                break
+            except Queue.Empty:
+                if not self.thread.isAlive() and self.queue.empty():
+                    self.thread = None
+                    raise StateError("Read-ahead thread exited unexpectedly")
+        if not done:
+            return result
+        self.close()
+        if result is not None:
+            raise result[0], result[1], result[2]
+        raise StopIteration
+
+    def close(self):
+        """Stop the background thread and wait for it to finish"""
+        if self.thread is not None:
+            self.stop.set()
+            self.thread.join()
+            self.thread = None
+
+    __del__ = close
+
+def _new_conversation(ecco):
+    """Open another connection to whatever `ecco` is connected to"""
+    if hasattr(ecco, 'conversation'):
+        return ecco.conversation()
+    return ecco.__class__()
+
+def _read_pages(cls, pages, queue, stop, operation=None):
+    import Queue
+    def put(item):
+        while not stop.isSet():
+            try:
+                queue.put(item, True, 0.05)
+                return True
+            except Queue.Full:
+                pass
+        return False
+    ecco = None
+    try:
+        try:
+            ecco = _new_conversation(Ecco)
+            for page in pages:
+                if not put((False, _resolve_page(cls, page, ecco, operation))):
+                    return
+            put((True, None))
+        except:
+            put((True, sys.exc_info()))
+    finally:
+        if ecco is not None:
+            ecco.close()
 
+def _find_item_subclass(cls, itemid=None, data=(), required=False):
+    if itemid is not None:
+        state = cache is not None and cache.state(itemid)
+        if state:
+            fids, values = state
+        else:
+            (fids, values), = _fetch_folders([itemid])
+    else:
+        fids, values = (), {}
+    return _resolve_subclass(cls, fids, values, itemid, data, required)
+
+def _item_states(ids, pagesize=None):
+    """List ``(folderids, values)`` for `ids`, using the cache if possible
+
+    Ids that the active cache doesn't fully know are fetched in bulk, in
+    pages of `pagesize` (see ``_fetch_folders()``).
+    """
+    states, missing = {}, {}
+    for itemid in ids:
+        state = cache is not None and cache.state(itemid)
+        if state:
+            states[itemid] = state
+        else:
+            missing[itemid] = True
+    missing = [itemid for itemid in ids if missing.pop(itemid, False)]
+    pagesize = pagesize or len(missing)
+    pages = [
+        missing[start:start+pagesize]
+        for start in range(0, len(missing), pagesize or 1)
+    ]
+    for page, rows in zip(pages, _map_pages(_fetch_folders, pages)):
+        states.update(zip(page, rows))
+    return [states[itemid] for itemid in ids]
+
+def _accepts_all(cls):
+    """True if every item resolves to `cls` or one of its subclasses"""
+    return not (
+        cls._folder_mask or cls._exclusion_mask or cls._required_values
+    ) and cls._validate_fields is _always_valid
+
+def _resolve_subclass(cls, fids, values, itemid=None, data=(), required=False):
+    """Find the subclass of `cls` for an item with `fids` and `values`"""
+    get = _folder_bits.get
+    mask = 0
+    for fid in fids:
+        mask |= get(fid, 0)
+    if data:
+        values = values.copy()
+        values.update(data)
+        for fid, val in data:
+            mask |= get(fid, 0)
+
+    match = None
+    select = _dispatcher(cls, True).select
+    while True:
+        found = select(mask, values, itemid)
+        if found is not None:
+            match = found
+            select = _dispatcher(found).select
+        elif match is None and required:
+            raise TypeError # XXX error message
+        else:
+            return match
+
+def _dispatcher(cls, root=False):
+    """The `_Dispatcher` for `cls` itself (if `root`) or its subclasses"""
+    try:
+        return _dispatchers[cls, root]
+    except KeyError:
+        if root:
+            candidates = [cls]
+        else:
+            candidates = [
+                c for c in cls.__subclasses__()
+                    if '_validate_fields' in c.__dict__
+            ]
+        d = _dispatchers[cls, root] = _Dispatcher(candidates)
+        return d
+
+class _Dispatcher(object):
+    """Choose among candidate item classes by folder mask and required values
+
+    Whether a candidate's folder masks and required values match depends only
+    on the item's relevant folder bits and on which of the required values (if
+    any) its values equal, so the candidates passing those tests are memoized
+    under that key.  Only ``_check_fields()`` validators, if any, are run for
+    each lookup, and only for the candidates that passed.
+    """
+
+    def __init__(self, candidates):
+        self.tests = []
+        self.mask = 0
+        choices = {}
+        for c in candidates:
+            checks = [
+                (f, v) for f, v in c._required_values.items() if v is not None
+            ]
+            for f, v in checks:
+                choices.setdefault(f, {})[v] = True
+            validate = c._validate_fields
+            if validate is _always_valid:
+                validate = None
+            self.mask |= c._folder_mask | c._exclusion_mask
+            self.tests.append(
+                (c, c._folder_mask, c._exclusion_mask, checks, validate)
+            )
+        self.choices = choices.items()
+        self.memo = {}
+
+    def select(self, mask, values, itemid=None):
+        """Return the matching candidate (or None) for `mask` and `values`"""
+        key = [mask & self.mask]
+        for f, wanted in self.choices:
+            v = values.get(f)
+            if v not in wanted:
+                v = None
+            key.append(v)
+        key = tuple(key)
+        try:
+            passed = self.memo[key]
+        except KeyError:
+            passed = self.memo[key] = self.compile(mask, values)
+        if len(passed)==1 and passed[0][1] is None:
+            return passed[0][0]
+        matches = [
+            c for c, validate in passed if validate is None or validate(values)
+        ]
+        if len(matches)>1:
+            raise TypeError("Validation ambiguity:", itemid or None, matches)
+        return matches and matches[0] or None
+
+    def compile(self, mask, values):
+        """List ``(cls, validator)`` for candidates matching mask and values"""
+        passed = []
+        for c, m, x, checks, validate in self.tests:
+            if (mask & m)!=m or (mask & x):
+                continue
+            for f, v in checks:
+                if values.get(f)!=v:
+                    break
+            else:
+                passed.append((c, validate))
+        return passed
+
+
+
+class _MemoryFile(object):
+    """The contents of one file open in a `MemoryEcco` server"""
+
+    def __init__(self, server):
+        self.server = server
+        self.name = '<Untitled>'
+        self.outline = []       # [(folderid, depth)] in outline order
+        self.names = {}         # folderid -> name
+        self.types = {}         # folderid -> FolderType
+        self.values = {}        # folderid -> {itemid: value}
+        self.popups = {}        # folderid -> [popup values]
+        self.text = {}          # itemid -> text
+        self.parents = {}       # itemid -> parent itemid (0 for top-level)
+        self.subs = {0: []}     # itemid -> [child itemids]
+        self.stamp = 0
+        self.changed = {}       # itemid -> stamp of last change
+        self.removed = {}       # folderid -> stamp of last removal
+        for name, ftype, depth in _default_folders:
+            self.add_folder(name, ftype, depth)
+
+    def copy(self):
+        import copy
+        return copy.deepcopy(self)
+
+    def touch(self, itemid):
+        self.stamp += 1
+        self.changed[itemid] = self.stamp
+
+    def add_folder(self, name, ftype, depth=2):
+        fid = self.server.new_id()
+        self.outline.append((fid, depth))
+        self.names[fid] = name
+        self.types[fid] = ftype
+        self.values[fid] = {}
+        if ftype==FolderType.PopUpList:
+            self.popups[fid] = []
+        return fid
+
+    def set_value(self, itemid, fid, value):
+        if itemid not in self.text:
+            raise KeyError("No such item:", itemid)
+        values = self.values[fid]
+        value = str(value)
+        if value:
+            if self.types[fid]==FolderType.CheckMark:
+                value = '1'
+            values[itemid] = value
+            popups = self.popups.get(fid)
+            if popups is not None and value not in popups:
+                popups.append(value)
+        elif itemid in values:
+            del values[itemid]
+            self.stamp += 1
+            self.removed[fid] = self.stamp
+        self.touch(itemid)
+
+    def folders_of(self, itemid):
+        values = self.values
+        return [fid for fid, depth in self.outline if itemid in values[fid]]
+
+    def detach(self, itemid):
+        self.subs[self.parents[itemid]].remove(itemid)
+
+    def ancestors(self, itemid):
+        parents = []
+        itemid = self.parents[itemid]
+        while itemid:
+            parents.append(itemid)
+            itemid = self.parents[itemid]
+        parents.reverse()
+        return parents
+
+    def walk(self, itemid, maxdepth, depth=1):
+        for sub in self.subs[itemid]:
+            yield depth, sub
+            if depth!=maxdepth:
+                for row in self.walk(sub, maxdepth, depth+1):
+                    yield row
+
+    def remove(self, itemid):
+        self.detach(itemid)
+        self.stamp += 1
+        for depth, sub in [(0, itemid)] + list(self.walk(itemid, 0)):
+            for fid, values in self.values.items():
+                if sub in values:
+                    del values[sub]
+                    self.removed[fid] = self.stamp
+            del self.text[sub], self.subs[sub], self.parents[sub]
+            self.changed.pop(sub, None)
+
+
+_default_folders = [
+    ('Ecco Folders', FolderType.CheckMark, 0),
+    ('PhoneBook', FolderType.CheckMark, 1),
+] + [
+    (name, FolderType.Text, 2) for name in """Mr./Ms.|Job Title|Company|
+    Address 1 - Business|Address 2 - Business|City - Business|State - Business|
+    Zip - Business|Country - Business|Work #|Home #|Fax #|Cell #|Alt #|
+    Address 1 - Home|Address 2 - Home|City - Home|State - Home|Zip - Home|
+    Country - Home""".replace('\n','').replace('    ','').split('|')
+] + [
+    ('Phone / Time Log', FolderType.Date, 2),
+    ('E-Mail', FolderType.Text, 2),
+    ('Appointments', FolderType.Date, 1),
+    ('Done', FolderType.Date, 1),
+    ('Start Dates', FolderType.Date, 1),
+    ('Due Dates', FolderType.Date, 1),
+    ("To-Do's", FolderType.Date, 1),
+    ('Search Results', FolderType.CheckMark, 1),
+    ('New Columns', FolderType.CheckMark, 1),
+    ('Net Location', FolderType.Text, 2),
+    ('Recurring Note Dates', FolderType.Date, 2),
+]
 
 
+def _sort_key(ftype):
+    """Return a function to convert raw `ftype` values to sortable keys"""
+    if ftype==FolderType.Number:
+        return Decimal
+    elif ftype==FolderType.Date:
+        return lambda value: value.ljust(12, '0')
+    return str
+
+def _criterion(ftype, op, arg):
+    """Return a predicate for raw values matching a GetFolderItems criterion
+
+    `op` is one of the value comparison ("GT", "EQ", etc.) or value text
+    ("TB", "TC", "TN") operators, and `ftype` is the type of the folder whose
+    values will be tested.  Item text operators ("IB", "IC", "IN") can be
+    tested by applying the returned function to the item text instead.
+    """
+    if op[1:] in ('B', 'C', 'N'):
+        arg = str(arg).lower()
+        if op[1]=='B':
+            return lambda value: value.lower().startswith(arg)
+        elif op[1]=='C':
+            return lambda value: arg in value.lower()
+        return lambda value: arg not in value.lower()
+    key = _sort_key(ftype)
+    arg, cmp_ = key(str(arg)), _comparisons[op]
+    def test(value):
+        try:
+            return cmp_(key(value), arg)
+        except ArithmeticError:
+            return False
+    return test
+
+_comparisons = dict(
+    GT=operator.gt, GE=operator.ge, LT=operator.lt, LE=operator.le,
+    EQ=operator.eq, NE=operator.ne,
+)
+
+def _select_items(items, ftype, extra, values, text):
+    """Apply GetFolderItems sorts and criteria (`extra`) to a list of `items`
+
+    `values` and `text` map item ids to their raw values in the folder being
+    queried (of type `ftype`), and to their text.  Returns a new list.
+    """
+    items, extra = list(items), list(extra)
+    while extra:
+        op = extra.pop(0)
+        if op in ('ia', 'id'):
+            items.sort(key=lambda i: text[i].lower(), reverse=op=='id')
+        elif op in ('va', 'vd'):
+            key = _sort_key(ftype)
+            items.sort(key=lambda i: key(values[i]), reverse=op=='vd')
+        elif op[0]=='I':
+            test = _criterion(ftype, op, extra.pop(0))
+            items = [i for i in items if test(text[i])]
+        else:
+            test = _criterion(ftype, op, extra.pop(0))
+            items = [i for i in items if test(values[i])]
+    return items
+
+
+def _simulated(func):
+    """Wrap a MemoryEcco method to lock the server, sleep, and keep counts"""
+    name = func.__name__
+    def method(self, *args, **kw):
+        server = self.server
+        server.lock.acquire()
+        try:
+            result = func(self, *args, **kw)
+        finally:
+            server.lock.release()
+        size = _count_values(args) + _count_values(kw.values())
+        size += _count_values(result)
+        self.calls[name] = self.calls.get(name, 0) + 1
+        self.payload[name] = self.payload.get(name, 0) + size
+        latency = self.latency
+        if isinstance(latency, dict):
+            latency = latency.get(name, 0)
+        delay = latency + self.per_value * size
+        if delay:
+            time.sleep(delay)
+        return result
+    method.__name__ = name
+    method.__doc__ = func.__doc__
+    return method
+
+def _count_values(ob):
+    if isinstance(ob, basestring) or not hasattr(ob, '__iter__'):
+        return ob is not None and 1 or 0
+    if hasattr(ob, 'items'):
+        ob = ob.items()
+    return sum([_count_values(v) for v in ob])
+
+def _many(ob):
+    return hasattr(ob, '__iter__') and not isinstance(ob, basestring)
+
+
+class _MemoryServer(object):
+    """Shared state for one or more `MemoryEcco` conversations"""
+
+    def __init__(self):
+        import threading
+        self.lock = threading.RLock()
+        self.files = {}     # session -> _MemoryFile
+        self.disk = {}      # pathname -> saved _MemoryFile
+        self.current = None
+        self.last_id = 0
+
+    def new_id(self):
+        self.last_id += 1
+        return self.last_id
+
+
+class MemoryEcco(object):
+    """In-memory stand-in for an ``ecco_dde.EccoDDE`` instance
+
+    Implements the parts of the EccoDDE API used by this module (plus the
+    file/session methods), so that item classes, queries and so on can be
+    exercised without a running copy of Ecco.  Install an instance as this
+    module's ``Ecco`` global to use it.
+
+    `latency` is a number of seconds to wait on every API call (or a dictionary
+    mapping method names to seconds), and `per_value` is an additional delay
+    for each value sent or received.  The ``calls`` and ``payload`` attributes
+    are dictionaries mapping method names to the number of calls made and the
+    number of values transferred, respectively.  Use ``conversation()`` to get
+    another instance (with its own latency and counts) talking to the same
+    simulated files.
+    """
+
+    latency = 0
+    per_value = 0
+
+    def __init__(self, latency=0, per_value=0, server=None):
+        self.latency = latency
+        self.per_value = per_value
+        self.server = server or _MemoryServer()
+        self.reset_stats()
+
+    def conversation(self, **kw):
+        """Return a new `MemoryEcco` connected to the same simulated files"""
+        kw.setdefault('latency', self.latency)
+        kw.setdefault('per_value', self.per_value)
+        return self.__class__(server=self.server, **kw)
+
+    def reset_stats(self):
+        """Reset the ``calls`` and ``payload`` counts"""
+        self.calls = {}
+        self.payload = {}
+
+    def total_calls(self):
+        """Total number of API calls made since the last ``reset_stats()``"""
+        return sum(self.calls.values())
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def _file(self):
+        try:
+            return self.server.files[self.server.current]
+        except KeyError:
+            raise StateError("No file is open")
+
+    file = property(_file)
+
+    # --- Files and sessions
+
+    def assert_session(self, session_id):
+        """Raise an error if active session is not `sessionId`"""
+        if self.GetCurrentFile() != session_id:
+            raise StateError("Attempt to close or save inactive session")
+
+    def close_all(self):
+        """Attempt to close all open files"""
+        while True:
+            session = self.GetCurrentFile()
+            if session is None: return
+            self.CloseFile(session)
+
+    decorate(_simulated)
+    def NewFile(self):
+        server = self.server
+        server.current = session = server.new_id()
+        server.files[session] = _MemoryFile(server)
+        return session
+
+    decorate(_simulated)
+    def OpenFile(self, pathname):
+        server = self.server
+        for session, f in server.files.items():
+            if f.name == pathname:
+                server.current = session
+                return session
+        if pathname not in server.disk:
+            raise FileNotOpened(pathname)
+        server.current = session = server.new_id()
+        server.files[session] = server.disk[pathname].copy()
+        return session
+
+    decorate(_simulated)
+    def SaveFile(self, session_id, pathname=None):
+        if self.server.current != session_id:
+            raise StateError("Attempt to close or save inactive session")
+        f = self.file
+        if pathname:
+            f.name = pathname
+        self.server.disk[f.name] = f.copy()
+
+    decorate(_simulated)
+    def CloseFile(self, session_id):
+        server = self.server
+        if server.current != session_id:
+            raise StateError("Attempt to close or save inactive session")
+        del server.files[session_id]
+        server.current = (server.files.keys() or [None])[-1]
+
+    decorate(_simulated)
+    def ChangeFile(self, session_id):
+        if session_id in self.server.files:
+            self.server.current = session_id
+
+    decorate(_simulated)
+    def GetOpenFiles(self):
+        return sorted(self.server.files)
+
+    decorate(_simulated)
+    def GetCurrentFile(self):
+        return self.server.current
+
+    decorate(_simulated)
+    def GetFileName(self, session_id):
+        return self.server.files[session_id].name
+
+    # --- Folders
+
+    decorate(_simulated)
+    def CreateFolder(self, name_or_dict, folder_type=FolderType.CheckMark):
+        f = self.file
+        if isinstance(name_or_dict, basestring):
+            return f.add_folder(name_or_dict, folder_type)
+        return dict([
+            (name, f.add_folder(name, ftype))
+            for name, ftype in name_or_dict.items()
+        ])
 
+    decorate(_simulated)
+    def GetFoldersByName(self, name):
+        f = self.file
+        return [fid for fid, depth in f.outline if f.names[fid]==name]
+
+    decorate(_simulated)
+    def GetFoldersByType(self, folder_type=0):
+        f = self.file
+        return [
+            fid for fid, depth in f.outline
+                if not folder_type or f.types[fid]==folder_type
+        ]
+
+    decorate(_simulated)
+    def GetFolderName(self, folder_id):
+        if _many(folder_id):
+            return map(self.file.names.__getitem__, folder_id)
+        return self.file.names[folder_id]
+
+    decorate(_simulated)
+    def SetFolderName(self, folder_id, name):
+        self.file.names[folder_id] = name
+
+    decorate(_simulated)
+    def GetFolderType(self, folder_id):
+        if _many(folder_id):
+            return map(self.file.types.__getitem__, folder_id)
+        return self.file.types[folder_id]
+
+    decorate(_simulated)
+    def GetFolderOutline(self):
+        return list(self.file.outline)
+
+    decorate(_simulated)
+    def GetPopupValues(self, folder_id):
+        if _many(folder_id):
+            return [list(self.file.popups[fid]) for fid in folder_id]
+        return list(self.file.popups[folder_id])
+
+    decorate(_simulated)
+    def GetFolderItems(self, folder_id, *extra):
+        f = self.file
+        values = f.values[folder_id]
+        return _select_items(
+            sorted(values), f.types[folder_id], extra, values, f.text
+        )
+
+    # --- Items
+
+    decorate(_simulated)
+    def CreateItem(self, item, data=()):
+        f = self.file
+        itemid = self.server.new_id()
+        f.text[itemid] = item
+        f.subs[itemid] = []
+        f.parents[itemid] = 0
+        f.subs[0].append(itemid)
+        f.touch(itemid)
+        for fid, value in data:
+            f.set_value(itemid, fid, value)
+        return itemid
+
+    decorate(_simulated)
+    def RemoveItem(self, item_id):
+        f = self.file
+        if not _many(item_id):
+            item_id = [item_id]
+        for itemid in item_id:
+            if itemid in f.text:
+                f.remove(itemid)
+
+    decorate(_simulated)
+    def GetItemText(self, item_id):
+        if _many(item_id):
+            return map(self.file.text.__getitem__, item_id)
+        return self.file.text[item_id]
+
+    decorate(_simulated)
+    def SetItemText(self, item_id, text=None):
+        f = self.file
+        if text is None:
+            items = item_id.items()
+        else:
+            items = [(item_id, text)]
+        for itemid, text in items:
+            if itemid not in f.text:
+                raise KeyError("No such item:", itemid)
+            f.text[itemid] = text
+            f.touch(itemid)
+
+    decorate(_simulated)
+    def GetItemType(self, item_id):
+        if _many(item_id):
+            return [ItemType.ItemText for i in item_id]
+        return ItemType.ItemText
+
+    decorate(_simulated)
+    def GetItemFolders(self, item_ids):
+        f = self.file
+        if not _many(item_ids):
+            return f.folders_of(item_ids)
+        result = []
+        for item in item_ids:
+            if not _many(item):
+                item = [item]
+            fids = {}
+            for i in item:
+                fids.update(dict.fromkeys(f.folders_of(i)))
+            result.append([fid for fid, d in f.outline if fid in fids])
+        return result
 
+    decorate(_simulated)
+    def GetFolderValues(self, item_ids, folder_ids):
+        f = self.file
+        items, fids = item_ids, folder_ids
+        if not _many(items): items = [items]
+        if not _many(fids): fids = [fids]
+        for i in items:
+            if i not in f.text:
+                raise KeyError("No such item:", i)
+        data = [[f.values[fid].get(i, '') for fid in fids] for i in items]
+        if not _many(folder_ids):
+            data = [row[0] for row in data]
+        if not _many(item_ids):
+            data, = data
+        return data
+
+    decorate(_simulated)
+    def SetFolderValues(self, item_ids, folder_ids, values):
+        f = self.file
+        if _many(folder_ids):
+            fids = list(folder_ids)
+            if _many(item_ids):
+                items, rows = list(item_ids), list(values)
+            else:
+                items, rows = [item_ids], [values]
+        else:
+            fids = [folder_ids]
+            if _many(item_ids):
+                items, rows = list(item_ids), [[v] for v in values]
+            else:
+                items, rows = [item_ids], [[values]]
+        if len(rows)!=len(items):
+            raise ValueError("Length mismatch between item_ids and values")
+        for itemid, row in zip(items, rows):
+            row = list(row)
+            if len(row)!=len(fids):
+                raise ValueError(
+                    "Length mismatch between folder_ids and values"
+                )
+            for fid, value in zip(fids, row):
+                f.set_value(itemid, fid, value)
+
+    decorate(_simulated)
+    def GetItemParents(self, item_id):
+        if _many(item_id):
+            return map(self.file.ancestors, item_id)
+        return self.file.ancestors(item_id)
+
+    decorate(_simulated)
+    def GetItemSubs(self, item_id, depth=0):
+        return list(self.file.walk(item_id, depth))
+
+    decorate(_simulated)
+    def InsertItem(self, anchor_id, items, where=InsertLevel.Indent):
+        f = self.file
+        if not _many(items): items = [items]
+        for itemid in items:
+            if itemid==anchor_id or anchor_id and (
+                itemid in f.ancestors(anchor_id)
+            ):
+                continue    # can't move an item inside itself
+            f.detach(itemid)
+            if where==InsertLevel.Indent:
+                parent, pos = anchor_id, 0
+            else:
+                anchor = anchor_id
+                if where==InsertLevel.Outdent:
+                    anchor = f.parents[anchor]
+                parent = f.parents[anchor]
+                pos = f.subs[parent].index(anchor) + 1
+            f.subs[parent].insert(pos, itemid)
+            f.parents[itemid] = parent
+            f.touch(itemid)
+
+    decorate(_simulated)
+    def GetChanges(self, timestamp, folder_ids=()):
+        f = self.file
+        items = [i for i, stamp in f.changed.items() if stamp>timestamp]
+        folders = [fid for fid, stamp in f.removed.items() if stamp>timestamp]
+        if folder_ids:
+            items = [
+                i for i in items
+                    if [fid for fid in folder_ids if i in f.values[fid]]
+            ]
+            folders = [fid for fid in folders if fid in folder_ids]
+        return f.stamp, sorted(items), sorted(folders)
+
+
+class Tracer(object):
+    """Record the Ecco API calls made by this module, and what made them
+
+    While a tracer is active (see ``begin()``), the ``Ecco`` global is wrapped
+    in a proxy that times each API call, counts the values passed in and out,
+    and notes the operation of this module that made the call.  Each call is
+    recorded as a ``(method, values, seconds, operation)`` tuple in ``calls``,
+    and passed to `hook` (if given) as it happens.
+
+    ``report()`` summarizes the calls by operation and method, and
+    ``suspects()`` lists operations that called a method for a single item (or
+    folder) at least `threshold` times: usually a sign of a loop making one
+    round trip per item (an "N+1" pattern), that a bulk call could replace.
+    """
+
+    def __init__(self, threshold=10, hook=None):
+        self.threshold = threshold
+        self.hook = hook
+        self.calls = []
+        self.single = {}    # (operation, method) -> count of one-item calls
+        self.previous = []
+
+    def begin(self):
+        """Start tracing calls, until ``end()`` is called"""
+        global Ecco
+        self.previous.append(Ecco)
+        Ecco = _TracedEcco(Ecco, self)
+        return self
 
+    def end(self):
+        """Restore the ``Ecco`` global that was in use before ``begin()``"""
+        global Ecco
+        Ecco = self.previous.pop()
+
+    __enter__ = begin
+
+    def __exit__(self, typ, val, tb):
+        self.end()
+
+    def record(self, method, args, result, seconds, frame):
+        """Record a call to `method`, made from `frame`"""
+        operation = _operation(frame)
+        size = _count_values(args) + _count_values(result)
+        call = method, size, seconds, operation
+        self.calls.append(call)
+        if args and not _many(args[0]):
+            key = operation, method
+            self.single[key] = self.single.get(key, 0) + 1
+        if self.hook is not None:
+            self.hook(*call)
+
+    def suspects(self):
+        """List ``(count, operation, method)`` for likely N+1 call patterns"""
+        result = [
+            (n, op, m) for (op, m), n in self.single.items()
+                if n>=self.threshold
+        ]
+        result.sort()
+        result.reverse()
+        return result
 
+    def report(self):
+        """Return a summary of the traced calls, as a string"""
+        totals = {}
+        for method, size, seconds, operation in self.calls:
+            n, v, t = totals.get((operation, method), (0, 0, 0.0))
+            totals[operation, method] = n+1, v+size, t+seconds
+        rows = [(n, v, t, m, op) for (op, m), (n, v, t) in totals.items()]
+        rows.sort()
+        rows.reverse()
+        lines = ["%d calls, %d values, %.3f seconds" % (len(self.calls),
+            sum([r[1] for r in rows]), sum([r[2] for r in rows])
+        )]
+        for row in rows:
+            lines.append("%6d calls %7d values %8.3fs  %s from %s" % row)
+        suspects = self.suspects()
+        if suspects:
+            lines.append("Possible N+1 patterns (one item per call):")
+            for row in suspects:
+                lines.append(
+                    "%6d calls  %s from %s" % (row[0], row[2], row[1])
+                )
+        return '\n'.join(lines)
+
+
+class _TracedEcco(object):
+    """Proxy for an Ecco API object, reporting its method calls to a tracer"""
+
+    def __init__(self, ecco, tracer):
+        self.ecco = ecco
+        self.tracer = tracer
+
+    def conversation(self):
+        return _TracedEcco(_new_conversation(self.ecco), self.tracer)
+
+    def __getattr__(self, name):
+        attr = getattr(self.ecco, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        tracer = self.tracer
+        def method(*args, **kw):
+            start = time.time()
+            result = attr(*args, **kw)
+            tracer.record(
+                name, args + tuple(kw.values()), result, time.time() - start,
+                sys._getframe(1)
+            )
+            return result
+        method.__name__ = name
+        return method
+
+def _operation(frame):
+    """Name of the innermost public function of this module in `frame`'s stack
+
+    Methods are named with their class, e.g. ``"TextFolder.__get__"``.  A
+    private helper working on behalf of a public operation that may no longer
+    be on the stack (such as a generator returned by ``__iter__()``, or a
+    read-ahead or pool thread) names it in an ``operation`` argument.  If all
+    the module's frames are private helpers, the innermost one is named.
+    """
+    first = None
+    while frame is not None and frame.f_globals is globals():
+        code = frame.f_code
+        name = short = code.co_name
+        arg = code.co_varnames[:code.co_argcount][:1]
+        if arg in (('self',), ('cls',)) and arg[0] in frame.f_locals:
+            ob = frame.f_locals[arg[0]]
+            if not isinstance(ob, type):
+                ob = type(ob)
+            if hasattr(ob, short):  # a method, not a function taking a class
+                name = ob.__name__ + '.' + name
+        if first is None:
+            first = name
+        if short[:1] not in '_<' or short[:2]==short[-2:]=='__':
+            return name
+        elif frame.f_locals.get('operation') and 'operation' in (
+            code.co_varnames[:code.co_argcount]
+        ):
+            return frame.f_locals['operation']
+        frame = frame.f_back
+    return first or '?'
+
+
+class EccoPool(object):
+    """Threads with Ecco conversations of their own, for parallel reads
+
+    While a pool is active (see ``begin()``), read-only work that can be split
+    up is spread over `size` threads: the operands of set operations on
+    queries are computed in parallel, as are the pages of items resolved when
+    iterating over queries or children, or exporting.  Each thread opens its
+    own conversation, by calling `factory` (by default, the ``conversation()``
+    method of the ``Ecco`` global if it has one, or else its class).
+
+    The ``Ecco`` global is replaced by a proxy that sends each pool thread's
+    calls to that thread's conversation, and all other calls to the original
+    ``Ecco`` object, so that writes still go over one connection, in order.
+    """
+
+    tasks = None
+
+    def __init__(self, size=4, factory=None):
+        self.size = size
+        self.factory = factory
+        self.previous = []
+
+    def begin(self):
+        """Start the threads and make this the active pool"""
+        global Ecco, pool
+        import threading, Queue
+        self.previous.append((Ecco, pool))
+        factory = self.factory or (lambda ecco=Ecco: _new_conversation(ecco))
+        self.local = threading.local()
+        self.tasks = Queue.Queue()
+        self.threads = []
+        for n in range(self.size):
+            t = threading.Thread(
+                target=_pool_worker, args=(factory, self.local, self.tasks)
+            )
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+        Ecco = _PooledEcco(Ecco, self.local)
+        pool = self
+        return self
 
+    def end(self):
+        """Stop the threads, and restore the previous ``Ecco`` and pool"""
+        global Ecco, pool
+        for t in self.threads:
+            self.tasks.put(None)
+        for t in self.threads:
+            t.join()
+        self.tasks = None
+        Ecco, pool = self.previous.pop()
+
+    __enter__ = begin
+
+    def __exit__(self, typ, val, tb):
+        self.end()
+
+    def map(self, func, items):
+        """Return ``map(func, items)``, with the calls spread over the pool
+
+        Calls made from one of the pool's own threads (or while the pool isn't
+        running) are made directly, one after another.
+        """
+        items = list(items)
+        if len(items)<2 or self.tasks is None or hasattr(self.local, 'ecco'):
+            return map(func, items)
+        import threading
+        results, done = [None] * len(items), threading.Semaphore(0)
+        for n, item in enumerate(items):
+            self.tasks.put((func, item, results, n, done))
+        for item in items:
+            done.acquire()
+        for ok, value in results:
+            if not ok:
+                raise value[0], value[1], value[2]
+        return [value for ok, value in results]
+
+
+def _pool_worker(factory, local, tasks):
+    try:
+        local.ecco = ecco = factory()
+    except:
+        ecco, error = None, sys.exc_info()    # report it for every task
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            func, item, results, n, done = task
+            if ecco is None:
+                results[n] = False, error
+            else:
+                try:
+                    results[n] = True, func(item)
+                except:
+                    results[n] = False, sys.exc_info()
+            done.release()
+    finally:
+        if ecco is not None:
+            ecco.close()
+
+class _PooledEcco(object):
+    """Proxy sending each pool thread's calls to its own conversation"""
+
+    def __init__(self, ecco, local):
+        self.ecco = ecco
+        self.local = local
+
+    def conversation(self):
+        return _new_conversation(self.ecco)
+
+    def __getattr__(self, name):
+        return getattr(getattr(self.local, 'ecco', self.ecco), name)
+
+
+class Replica(object):
+    """A local SQLite copy of an Ecco file, for fast reads and ad-hoc SQL
+
+    ``refresh()`` copies the folder outline, item outline, item text and folder
+    values from Ecco (or from `source`, if given) into the SQLite database at
+    `path`.  The first refresh copies everything.  Later ones (even from
+    another process, if `path` is a file) ask Ecco which items have changed
+    and which folders have had items removed since the last refresh, read
+    only the changed items and those with stored values in such folders, and
+    rewrite only the ones whose content hash differs from the stored copy's.
+
+    While a replica is active (see ``begin()``), it takes the place of the
+    ``Ecco`` global, so that item classes, folders and queries are answered
+    from the database without talking to Ecco.  Replicas are read-only: API
+    calls that would change the file raise ``StateError``.  ``sql()`` runs
+    arbitrary queries against the replica's tables, which are::
+
+        folders(id, name, type, depth, position)
+        items(id, text, parent, depth, position, hash)
+        item_values(item, folder, raw, value)
+
+    where ``position`` is a folder or item's index in outline order (``parent``
+    is 0 for top-level items), and ``raw`` is a folder value as Ecco returns
+    it.  ``value`` is the same value decoded by its folder class, with numbers
+    stored as numbers, checkmarks as 1, and dates and times as ISO strings.
+    """
+
+    def __init__(self, path=':memory:', source=None, pagesize=200):
+        try:
+            import sqlite3
+        except ImportError:
+            from pysqlite2 import dbapi2 as sqlite3
+        self.path = path
+        self.source = source
+        self.pagesize = pagesize
+        self.previous = []
+        self.db = sqlite3.connect(path)
+        self.db.text_factory = str
+        self.db.executescript(_replica_tables)
+
+    def begin(self):
+        """Use this replica in place of the ``Ecco`` global, until ``end()``"""
+        global Ecco
+        self.previous.append(Ecco)
+        Ecco = self
+        return self
 
+    def end(self):
+        """Restore the ``Ecco`` global that was replaced by ``begin()``"""
+        global Ecco
+        Ecco = self.previous.pop()
+
+    __enter__ = begin
+
+    def __exit__(self, typ, val, tb):
+        self.end()
+
+    def conversation(self):
+        """Return a new `Replica` for the same database, for use by a thread"""
+        if self.path==':memory:':
+            raise StateError("An in-memory replica can't be shared")
+        return self.__class__(self.path, self.source, self.pagesize)
+
+    def open(self):
+        pass
+
+    def close(self):
+        """Close the database connection"""
+        self.db.close()
+
+    def sql(self, query, *params):
+        """Run an SQL `query` with `params`; return a list of row tuples"""
+        return self.db.execute(query, params).fetchall()
+
+    def refresh(self, full=False):
+        """Bring the replica up to date; return ``(added, changed, removed)``
+
+        If `full` is true, every item is read from Ecco, not just the new ones
+        and those that Ecco reports as changed since the last refresh.  Either
+        way, only items whose text or values have changed are rewritten.
+        """
+        ecco = self.source
+        if ecco is None:
+            ecco = Ecco
+            if ecco is self:
+                ecco = self.previous[-1]
+        db = self.db
+        try:
+            row = db.execute("select value from meta where key='stamp'")
+            row = row.fetchone()
+            stamp, changed, emptied = ecco.GetChanges(row and row[0] or 0)
+            types = self._copy_folders(ecco)
+            outline = ecco.GetItemSubs(0, 0)
+            known = dict(db.execute("select id, hash from items"))
+
+            # Items removed from a folder aren't necessarily listed as changed,
+            # so re-check every item that has a stored value in such a folder
+            wanted = dict.fromkeys(changed)
+            for itemid, in self._select(
+                "select distinct item from item_values where folder in (%s)",
+                emptied
+            ):
+                wanted[itemid] = True
+            present, positions, parents = {}, [], [0]
+            for position, (depth, itemid) in enumerate(outline):
+                del parents[depth:]
+                positions.append((parents[-1], depth, position, itemid))
+                parents.append(itemid)
+                present[itemid] = True
+            ids = [
+                itemid for depth, itemid in outline
+                    if full or row is None or itemid in wanted
+                        or itemid not in known
+            ]
+
+            added = updated = 0
+            for start in range(0, len(ids), self.pagesize):
+                page = ids[start:start+self.pagesize]
+                texts = ecco.GetItemText(page)
+                folders = ecco.GetItemFolders(page)
+                fids = {}
+                for item_fids in folders:
+                    fids.update(dict.fromkeys(item_fids))
+                fids = fids.keys()
+                if fids:
+                    rows = ecco.GetFolderValues(page, fids)
+                else:
+                    rows = [[]] * len(page)
+                for itemid, text, item_fids, row in zip(
+                    page, texts, folders, rows
+                ):
+                    row = dict(zip(fids, row))
+                    values = [(fid, row[fid]) for fid in item_fids]
+                    values.sort()
+                    digest = _md5(repr((text, values))).hexdigest()
+                    if itemid not in known:
+                        added += 1
+                        db.execute(
+                            "insert into items (id, text, hash)"
+                            " values (?, ?, ?)", (itemid, text, digest)
+                        )
+                    elif known[itemid] != digest:
+                        updated += 1
+                        db.execute(
+                            "update items set text=?, hash=? where id=?",
+                            (text, digest, itemid)
+                        )
+                        db.execute(
+                            "delete from item_values where item=?", (itemid,)
+                        )
+                    else:
+                        continue
+                    db.executemany(
+                        "insert into item_values values (?, ?, ?, ?)", [
+                            (itemid, fid, raw, _replica_value(types[fid], raw))
+                            for fid, raw in values
+                        ]
+                    )
+
+            removed = [(itemid,) for itemid in known if itemid not in present]
+            db.executemany("delete from items where id=?", removed)
+            db.executemany("delete from item_values where item=?", removed)
+            db.executemany(
+                "update items set parent=?, depth=?, position=? where id=?",
+                positions
+            )
+            db.execute(
+                "insert or replace into meta values ('stamp', ?)", (stamp,)
+            )
+        except:
+            db.rollback()
+            raise
+        db.commit()
+        return added, updated, len(removed)
+
+    def _copy_folders(self, ecco):
+        """Replace the stored folders with Ecco's; return a type dictionary"""
+        outline = ecco.GetFolderOutline()
+        fids = [fid for fid, depth in outline]
+        names = ecco.GetFolderName(fids)
+        types = ecco.GetFolderType(fids)
+        db = self.db
+        db.execute("delete from folders")
+        db.executemany("insert into folders values (?, ?, ?, ?, ?)", [
+            (fid, name, ftype, depth, position)
+            for position, ((fid, depth), name, ftype)
+                in enumerate(zip(outline, names, types))
+        ])
+        db.execute(
+            "delete from item_values"
+            " where folder not in (select id from folders)"
+        )
+        return dict(zip(fids, types))
+
+    def _select(self, query, ids):
+        """Yield the rows of `query` for `ids`, which fill its ``in (%s)``"""
+        ids = list(ids)
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start+500]
+            marks = ','.join(['?'] * len(chunk))
+            for row in self.db.execute(query % marks, chunk):
+                yield row
+
+    def _lookup(self, table, column, ids):
+        """`column` of the row for id `ids` (or a list of them, for several)"""
+        found = dict(self._select(
+            "select id, %s from %s where id in (%%s)" % (column, table),
+            _many(ids) and ids or [ids]
+        ))
+        if _many(ids):
+            return map(found.__getitem__, ids)
+        return found[ids]
+
+    def __getattr__(self, name):
+        if name[:1].isupper():
+            raise StateError("Replicas are read-only; can't call " + name)
+        raise AttributeError(name)
+
+    # --- Read-only EccoDDE API, answered from the database
+
+    def GetFolderOutline(self):
+        return self.sql("select id, depth from folders order by position")
+
+    def GetFoldersByName(self, name):
+        return [fid for fid, in self.sql(
+            "select id from folders where name=? order by position", name
+        )]
+
+    def GetFoldersByType(self, folder_type=0):
+        return [fid for fid, in self.sql(
+            "select id from folders where ? in (0, type) order by position",
+            folder_type
+        )]
+
+    def GetFolderName(self, folder_id):
+        return self._lookup('folders', 'name', folder_id)
+
+    def GetFolderType(self, folder_id):
+        return self._lookup('folders', 'type', folder_id)
+
+    def GetFolderItems(self, folder_id, *extra):
+        values, text = {}, {}
+        for itemid, raw, item_text in self.db.execute(
+            "select v.item, v.raw, i.text from item_values v"
+            " join items i on i.id=v.item where v.folder=?", (folder_id,)
+        ):
+            values[itemid], text[itemid] = raw, item_text
+        return _select_items(
+            sorted(values), self.GetFolderType(folder_id), extra, values, text
+        )
+
+    def GetItemText(self, item_id):
+        return self._lookup('items', 'text', item_id)
+
+    def GetItemFolders(self, item_ids):
+        groups = item_ids
+        if not _many(item_ids):
+            groups = [item_ids]
+        ids = []
+        for item in groups:
+            if _many(item):
+                ids.extend(item)
+            else:
+                ids.append(item)
+        found = {}
+        for itemid, fid in self._select(
+            "select v.item, v.folder from item_values v join folders f"
+            " on f.id=v.folder where v.item in (%s) order by f.position", ids
+        ):
+            found.setdefault(itemid, []).append(fid)
+        if not _many(item_ids):
+            return found.get(item_ids, [])
+        result = []
+        for item in groups:
+            if not _many(item):
+                result.append(found.get(item, []))
+                continue
+            fids = {}
+            for i in item:
+                fids.update(dict.fromkeys(found.get(i, ())))
+            result.append([
+                fid for fid, depth in self.GetFolderOutline() if fid in fids
+            ])
+        return result
 
+    def GetFolderValues(self, item_ids, folder_ids):
+        items, fids = item_ids, folder_ids
+        if not _many(items): items = [items]
+        if not _many(fids): fids = [fids]
+        self._lookup('items', 'id', items)  # KeyError for unknown items
+        found = {}
+        for itemid, fid, raw in self._select(
+            "select item, folder, raw from item_values where item in (%s)",
+            items
+        ):
+            found[itemid, fid] = raw
+        data = [[found.get((i, fid), '') for fid in fids] for i in items]
+        if not _many(folder_ids):
+            data = [row[0] for row in data]
+        if not _many(item_ids):
+            data, = data
+        return data
+
+    def _ancestors(self, itemid):
+        parents = []
+        itemid = self._lookup('items', 'parent', itemid)
+        while itemid:
+            parents.append(itemid)
+            itemid = self._lookup('items', 'parent', itemid)
+        parents.reverse()
+        return parents
+
+    def GetItemParents(self, item_id):
+        if _many(item_id):
+            return map(self._ancestors, item_id)
+        return self._ancestors(item_id)
+
+    def GetItemSubs(self, item_id, depth=0):
+        start, base = -1, 0
+        if item_id:
+            row = self.db.execute(
+                "select position, depth from items where id=?", (item_id,)
+            ).fetchone()
+            if row is None:
+                raise KeyError(item_id)
+            start, base = row
+        subs = []
+        for sub_depth, itemid in self.db.execute(
+            "select depth, id from items where position>? order by position",
+            (start,)
+        ):
+            if sub_depth<=base:
+                break
+            if not depth or sub_depth-base<=depth:
+                subs.append((sub_depth-base, itemid))
+        return subs
+
+
+_replica_tables = """
+create table if not exists folders (
+    id integer primary key, name text, type integer, depth integer,
+    position integer
+);
+create table if not exists items (
+    id integer primary key, text text, parent integer, depth integer,
+    position integer, hash text
+);
+create index if not exists items_by_position on items (position);
+create table if not exists item_values (
+    item integer, folder integer, raw text, value,
+    primary key (item, folder)
+);
+create index if not exists values_by_folder on item_values (folder, value);
+create table if not exists meta (key text primary key, value);
+"""
+
+def _replica_value(ftype, raw):
+    """Decode a raw folder value for storage in a replica's ``value`` column"""
+    value = folder_decoders[ftype](raw)
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    elif isinstance(value, Decimal):
+        return float(value)
+    return value
+
+try:
+    from hashlib import md5 as _md5
+except ImportError:
+    from md5 import new as _md5
 
 
+def additional_tests():
+    import doctest, sys
+    saved = []
+    def setUp(test):
+        global Ecco
+        if sys.platform != 'win32':
+            saved.append(Ecco)
+            Ecco = MemoryEcco()     # no Ecco to talk to; use a simulated one
+    def tearDown(test):
+        global Ecco
+        if saved:
+            Ecco = saved.pop()
+    suite = doctest.DocFileSuite(
+        'README.txt', setUp=setUp, tearDown=tearDown,
+        optionflags=doctest.ELLIPSIS|doctest.NORMALIZE_WHITESPACE,
+    )
+    try:
+        import benchmark    # only in the source tree, not when installed
+    except ImportError:
+        pass
+    else:
+        import unittest
+        suite.addTest(unittest.FunctionTestCase(benchmark.test_call_counts))
+    return suite